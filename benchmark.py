@@ -0,0 +1,284 @@
+#benchmark harness for ingestion, class search and custom search
+#
+#usage: python benchmark.py --scales 1,4,16 --output bench.json
+#
+#every run works on fresh temporary folders and a temporary sqlite db, the
+#Brick schema store under schema_db is shared with the application
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+from io import BytesIO
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import jsonldviewer
+from jsonldviewer import app, brick_uri, brickframe_uri, site_uri
+
+
+#-------------------------------------------------------------------------
+#classes searched by searchByClass, from the root of a hierarchy down
+DEFAULT_CLASSES = ['Point', 'Sensor', 'Temperature_Sensor', 'Zone_Temperature_Sensor',
+                   'Equipment', 'HVAC', 'AHU', 'VAV',
+                   'Location', 'Room']
+
+#terms searched by customSearch in every position
+DEFAULT_TERMS = ['vav', 'temp', 'feeds', 'room_1']
+
+POINT_CLASSES = ['Zone_Temperature_Sensor', 'Supply_Air_Temperature_Sensor',
+                 'Supply_Air_Flow_Sensor', 'Damper_Position_Command',
+                 'Zone_Temperature_Setpoint']
+
+
+#-------------------------------------------------------------------------
+def generate_building(equipment, points, locations, relationships, seed=0):
+    """Generates a synthetic Brick building as a jsonld document.
+
+    Parameters:
+        ---equipment = number of equipment, one AHU for every ten VAVs
+        ---points = number of points, spread evenly over the equipment
+        ---locations = number of rooms, spread over floors of twenty
+        ---relationships = number of extra bf:feeds links between equipment
+        ---seed = seed of the random generator, the same arguments and seed
+        always give the same document
+
+    Returns:
+        ---the document as a dict
+    """
+    rnd = random.Random(seed)
+    graph = list()
+
+    floors = ['Floor_%d' % i for i in range(max(1, (locations + 19) // 20))]
+    for floor in floors:
+        graph.append({'@id': 'site:' + floor, '@type': 'brick:Floor'})
+
+    rooms = ['Room_%d' % i for i in range(locations)]
+    for i, room in enumerate(rooms):
+        graph.append({'@id': 'site:' + room, '@type': 'brick:Room',
+                      'isPartOf': 'site:' + floors[i // 20]})
+
+    ahus = ['AHU_%d' % i for i in range(max(1, equipment // 11))]
+    vavs = ['VAV_%d' % i for i in range(max(0, equipment - len(ahus)))]
+    names = ahus + vavs
+    nodes = dict()
+    for ahu in ahus:
+        nodes[ahu] = {'@id': 'site:' + ahu, '@type': 'brick:AHU', 'feeds': list(), 'hasPoint': list()}
+    for i, vav in enumerate(vavs):
+        nodes[vav] = {'@id': 'site:' + vav, '@type': 'brick:VAV', 'hasPoint': list()}
+        nodes[ahus[i % len(ahus)]]['feeds'].append('site:' + vav)
+        if rooms:
+            nodes[vav]['hasLocation'] = 'site:' + rooms[i % len(rooms)]
+
+    for i in range(relationships):
+        source, target = rnd.choice(ahus), rnd.choice(names)
+        if target != source:
+            nodes[source]['feeds'].append('site:' + target)
+
+    for i in range(points):
+        owner = names[i % len(names)]
+        point = 'site:%s_Point_%d' % (owner, i)
+        nodes[owner]['hasPoint'].append(point)
+        graph.append({'@id': point, '@type': 'brick:' + rnd.choice(POINT_CLASSES),
+                      'isPointOf': 'site:' + owner})
+
+    graph.extend(nodes[name] for name in names)
+
+    context = {'brick': brick_uri,
+               'bf': brickframe_uri,
+               'site': site_uri}
+    for relation in ['feeds', 'hasPoint', 'isPointOf', 'hasLocation', 'isPartOf']:
+        context[relation] = {'@id': 'bf:' + relation, '@type': '@id'}
+
+    return {'@context': context, '@graph': graph}
+
+#-------------------------------------------------------------------------
+def percentiles(samples):
+    "Returns latency statistics in milliseconds for a list of seconds"
+    ordered = sorted(samples)
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+    return {'n': len(ordered),
+            'min': pick(0), 'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99),
+            'max': round(ordered[-1] * 1000, 3),
+            'mean': round(sum(ordered) / len(ordered) * 1000, 3)}
+
+#-------------------------------------------------------------------------
+def peak_rss():
+    """Returns the peak resident set size in kilobytes of this process and
+    of its finished children (the ingest workers), where available"""
+    if resource is None:
+        return None
+    scale = 1024 if sys.platform == 'darwin' else 1
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale}
+
+#-------------------------------------------------------------------------
+def post_json(client, url, payload):
+    "POSTs a json payload and returns the decoded json response"
+    rv = client.post(url, data=json.dumps(payload), content_type='application/json')
+    if rv.status_code != 200:
+        raise RuntimeError('%s returned %d' % (url, rv.status_code))
+    return json.loads(rv.data.decode('utf-8'))
+
+#-------------------------------------------------------------------------
+def upload(client, filetitle, document, timeout):
+    """Uploads a document through /addfile and waits for its ingest job.
+
+    Returns:
+        ---(seconds until the job finished, triples written, bytes uploaded)
+    """
+    data = json.dumps(document).encode('utf-8')
+    started = time.time()
+    rv = client.post('/addfile', headers={'Accept': 'application/json'}, data={
+        'filetitle': filetitle,
+        'filedesc': 'benchmark building',
+        'jsonldfile': (BytesIO(data), filetitle + '.jsonld')})
+    if rv.status_code != 202:
+        raise RuntimeError('/addfile returned %d' % rv.status_code)
+    jobid = json.loads(rv.data.decode('utf-8'))['jobid']
+
+    while True:
+        job = json.loads(client.get('/jobs/' + jobid).data.decode('utf-8'))
+        if job['status'] in ('done', 'failed'):
+            break
+        if time.time() - started > timeout:
+            raise RuntimeError('ingest of %s timed out' % filetitle)
+        time.sleep(0.05)
+    if job['status'] == 'failed':
+        raise RuntimeError('ingest of %s failed:\n%s' % (filetitle, job['error']))
+    return time.time() - started, job['triples'], len(data)
+
+#-------------------------------------------------------------------------
+def time_requests(client, url, payload, repeat):
+    """Times repeated POSTs of the same search.
+
+    Returns:
+        ---(latency statistics, number of rows of the last response)
+    """
+    samples = list()
+    for i in range(repeat):
+        started = time.time()
+        result = post_json(client, url, payload)
+        samples.append(time.time() - started)
+    if isinstance(result, dict) and isinstance(result.get('result'), dict):
+        rows = sum(len(bucket) for bucket in result['result'].values())
+    elif isinstance(result, dict):
+        rows = len(result.get('result', ()))
+    else:
+        rows = len(result)
+    return percentiles(samples), rows
+
+#-------------------------------------------------------------------------
+def run_scale(client, scale, args):
+    "Uploads one synthetic building and times searches against it"
+    counts = {'equipment': args.equipment * scale,
+              'points': args.points * scale,
+              'locations': args.locations * scale,
+              'relationships': args.relationships * scale}
+    document = generate_building(seed=args.seed, **counts)
+    filetitle = 'bench_%d_%d' % (scale, int(time.time() * 1000))
+
+    seconds, triples, size = upload(client, filetitle, document, args.timeout)
+    report = {'scale': scale,
+              'counts': counts,
+              'upload': {'seconds': round(seconds, 3),
+                         'triples': triples,
+                         'bytes': size,
+                         'triples_per_second': round(triples / max(seconds, 1e-6), 1)},
+              'searchByClass': dict(),
+              'customSearch': dict()}
+
+    for brickClass in args.classes:
+        stats, rows = time_requests(client, '/searchByClass',
+            {'filetitle': filetitle, 'brickClass': brickClass}, args.repeat)
+        stats['rows'] = rows
+        report['searchByClass'][brickClass] = stats
+
+    for term in args.terms:
+        report['customSearch'][term] = dict()
+        for position in ['subject', 'property', 'object', 'all']:
+            stats, rows = time_requests(client, '/customSearch',
+                {'filetitle': filetitle, 'searchTerm': term, 'selectedPosition': position}, args.repeat)
+            stats['rows'] = rows
+            report['customSearch'][term][position] = stats
+
+    report['peak_rss_kb'] = peak_rss()
+    return report
+
+#-------------------------------------------------------------------------
+def git_commit():
+    "Returns the commit the benchmark ran against, if known"
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#-------------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks ingestion, class search and '
+        'custom search over synthetic Brick buildings and prints a json report.')
+    parser.add_argument('--scales', default='1,4,16',
+        help='comma separated size multipliers, one building is uploaded per scale')
+    parser.add_argument('--equipment', type=int, default=110)
+    parser.add_argument('--points', type=int, default=500)
+    parser.add_argument('--locations', type=int, default=60)
+    parser.add_argument('--relationships', type=int, default=50)
+    parser.add_argument('--classes', default=','.join(DEFAULT_CLASSES))
+    parser.add_argument('--terms', default=','.join(DEFAULT_TERMS))
+    parser.add_argument('--repeat', type=int, default=20, help='timed requests per search')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=3600, help='seconds to wait for an ingest')
+    parser.add_argument('--with-cache', action='store_true',
+        help='leave the search result cache on, repeats are then cache hits')
+    parser.add_argument('--output', help='file to write the report to instead of stdout')
+    args = parser.parse_args(argv)
+    args.classes = [c for c in args.classes.split(',') if c]
+    args.terms = [t for t in args.terms.split(',') if t]
+
+    workdir = tempfile.mkdtemp(prefix='jsonldviewer-bench-')
+    try:
+        #must be set before the first upload starts the ingest pool
+        jsonldviewer.SLEEPYCAT_DB_FOLDER = os.path.join(workdir, 'sleepycat_db')
+        jsonldviewer.INDEX_DB_FOLDER = os.path.join(workdir, 'index_db')
+        jsonldviewer.SHARED_DB_FOLDER = os.path.join(workdir, 'shared_db')
+        jsonldviewer.SNAPSHOT_DB_FOLDER = os.path.join(workdir, 'snapshot_db')
+        jsonldviewer.PREFIX_DB_FOLDER = os.path.join(workdir, 'prefix_db')
+        app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+        app.config['DATABASE'] = os.path.join(workdir, 'jsonldviewer.db')
+        app.config['TESTING'] = True
+        os.makedirs(app.config['UPLOAD_FOLDER'])
+        if not args.with_cache:
+            jsonldviewer.result_cache.maxrows = 0
+
+        client = app.test_client()
+
+        report = {'commit': git_commit(),
+                  'started': datetime.now().isoformat(),
+                  'python': platform.python_version(),
+                  'repeat': args.repeat,
+                  'cache': args.with_cache,
+                  'runs': [run_scale(client, int(scale), args) for scale in args.scales.split(',')]}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+create table meta (
+    key text primary key,
+    value text not null
+);
+
+create table types (
+    class text not null,
+    instance text not null
+);
+
+create table subclasses (
+    sub text not null,
+    sup text not null
+);
+
+create table terms (
+    id integer primary key,
+    term text not null,
+    bnode integer not null default 0,
+    unique (term, bnode)
+);
+
+create table grams (
+    gram text not null,
+    term integer not null
+);
+
+create table triples (
+    s integer not null,
+    p integer not null,
+    o integer not null
+);
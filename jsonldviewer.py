@@ -2,16 +2,48 @@
 import os
 import shutil
 import sqlite3
+import hashlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import traceback
+import uuid
+import io
+import sys
+import signal
+import mmap
+import struct
+from array import array
+import time
+import gzip
+import base64
+import itertools
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 import re
-from flask import Flask, request, session, g, redirect, url_for, abort, render_template, flash, jsonify
+import click
+from werkzeug.serving import make_server
+from flask import Flask, request, session, g, redirect, url_for, abort, render_template, flash, jsonify, Response
 from werkzeug.utils import secure_filename
 import json
+import csv
+from six import text_type, string_types
+from six.moves.urllib.parse import urljoin
+from six.moves.urllib.request import pathname2url
 
 #import statements: rdf related
 import rdflib
+from rdflib.compare import to_isomorphic
 from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.algebra import translateQuery
+from rdflib.plugins.sparql.evaluate import evalPart
+from rdflib.plugins.sparql.parser import parseQuery
+from rdflib.plugins.sparql.sparql import QueryContext
 import rdflib.plugins.sparql.results.jsonlayer as jl
+from rdflib_jsonld.context import Context as JsonLdContext
+from rdflib_jsonld.parser import Parser as JsonLdParser
 
 
 #-------------------------------------------------------------------------
@@ -33,6 +65,17 @@ SLEEPYCAT_DB_FOLDER = os.path.join(APP_ROOT, 'sleepycat_db')
 BRICKFRAME_PATH = os.path.join(APP_ROOT, 'brick_schema', 'BrickFrame.ttl')
 BRICKTAG_PATH = os.path.join(APP_ROOT, 'brick_schema', 'BrickTag.ttl')
 BRICK_PATH = os.path.join(APP_ROOT, 'brick_schema', 'Brick.ttl')
+SCHEMA_DB_FOLDER = os.path.join(APP_ROOT, 'schema_db')
+INDEX_DB_FOLDER = os.path.join(APP_ROOT, 'index_db')
+SHARED_DB_FOLDER = os.path.join(APP_ROOT, 'shared_db')
+SNAPSHOT_DB_FOLDER = os.path.join(APP_ROOT, 'snapshot_db')
+PREFIX_DB_FOLDER = os.path.join(APP_ROOT, 'prefix_db')
+SCHEMA_DIGEST_FILE = 'schema.sha1'
+
+#schema graphs shared by every building, in the order they are loaded
+SCHEMA_GRAPHS = [(BRICKFRAME_GRAPH, BRICKFRAME_PATH),
+                 (BRICKTAG_GRAPH, BRICKTAG_PATH),
+                 (BRICK_GRAPH, BRICK_PATH)]
 
 
 #uris
@@ -45,6 +88,36 @@ bricktag_uri = 'http://buildsys.org/ontologies/BrickTag#'
 brick_uri = 'http://buildsys.org/ontologies/Brick#'
 site_uri = 'http://jci.buildings.org/ontology/carsongulley#'
 
+#namespaces : built once, shared by every query
+BRICK = rdflib.Namespace(brick_uri)
+SITE = rdflib.Namespace(site_uri)
+
+#prefixes used to compact IRIs in every response
+NAMESPACES = [('rdf', rdf_uri),
+              ('rdfs', rdfs_uri),
+              ('owl', owl_uri),
+              ('skos', skos_uri),
+              ('bf', brickframe_uri),
+              ('tag', bricktag_uri),
+              ('brick', brick_uri),
+              ('site', site_uri)]
+
+#custom search positions and the variable each one filters on
+POSITION_VARS = OrderedDict([('subject', 's'), ('property', 'p'), ('object', 'o')])
+POSITION_BUCKETS = {'subject': 'subjectwise', 'property': 'propertywise', 'object': 'objectwise'}
+
+#bumped whenever index_schema.sql changes, older indexes are ignored
+INDEX_FORMAT = '4'
+
+#building snapshots : the magic, the number of terms and of triples, then
+#the offsets of the term offsets, the term data and the SPO, POS and OSP
+#triple arrays, all little endian
+SNAPSHOT_MAGIC = b'JLDSNAP1'
+SNAPSHOT_HEADER = struct.Struct('<8s7Q')
+SNAPSHOT_ROW = struct.Struct('<3I')
+#positions of s, p and o in the rows of the SPO, POS and OSP arrays
+SNAPSHOT_ORDERS = [(0, 1, 2), (1, 2, 0), (2, 0, 1)]
+
 sf_ttl = 'turtle'
 sf_jsonld = 'jsonld'
 
@@ -66,25 +139,127 @@ app.config.update(dict(
     DATABASE=os.path.join(app.root_path, 'jsonldviewer.db'),
     SECRET_KEY='brickschemajsonld',
     USERNAME='admin',
-    PASSWORD='admin'
+    PASSWORD='admin',
+    INGEST_WORKERS=2,
+    INGEST_BATCH_SIZE=5000,
+    DATASET_CACHE_SIZE=16,
+    DATASET_IDLE_TIMEOUT=300,
+    RESULT_CACHE_SIZE=256,
+    RESULT_CACHE_TTL=600,
+    RESULT_CACHE_MAX_ROWS=10000,
+    VIEWER_GZIP=True,
+    NODE_PAGE_SIZE=50,
+    WRITE_SNAPSHOTS=True,
+    DB_POOL_SIZE=8,
+    DB_TIMEOUT=30,
+    FILES_PAGE_SIZE=50,
+    SPARQL_TIMEOUT=30,
+    SPARQL_MAX_ROWS=100000,
+    SPARQL_MAX_QUERIES=4,
+    SPARQL_MAX_PER_BUILDING=2,
+    AUTOCOMPLETE_MEMORY=256 * 1024 * 1024,
+    AUTOCOMPLETE_LIMIT=10,
+    METRICS_FOLDER=None,
+    STORAGE_MODE='building',
+    PORTFOLIO_WORKERS=8,
+    PORTFOLIO_TIMEOUT=10,
+    PORTFOLIO_MAX_ROWS=1000
 ))
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config.from_envvar('JSONLDVIEWER_SETTINGS', silent=True)
 
+#-------------------------------------------------------------------------
+#set once the sqlite db has been checked against schema.sql in this process
+_db_upgraded = False
+
 #-------------------------------------------------------------------------
 def connect_db():
-    "This function connects to a local sqlite db"
-    rv = sqlite3.connect(app.config['DATABASE'])
+    """This function connects to a local sqlite db. The db is kept in
+    WAL mode, so readers are not blocked while an ingest job writes.
+    Connections may be handed between threads, never used by two at once."""
+    global _db_upgraded
+    rv = sqlite3.connect(app.config['DATABASE'], timeout=app.config['DB_TIMEOUT'],
+        check_same_thread=False)
     rv.row_factory = sqlite3.Row
+    rv.execute('pragma synchronous = normal')
+    if not _db_upgraded:
+        rv.execute('pragma journal_mode = wal')
+        upgrade_db(rv)
+        _db_upgraded = True
     return rv
 
+#-------------------------------------------------------------------------
+class ConnectionPool(object):
+    """Per process pool of idle connections to the sqlite db, so that
+    requests reuse connections instead of opening one each. Connections
+    inherited from a parent process are dropped, never used."""
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = list()
+        self.owner = None
+
+    def get(self):
+        "Returns an idle connection, or a new one when there is none"
+        with self.lock:
+            owner = (os.getpid(), app.config['DATABASE'])
+            if self.owner != owner:
+                self.idle = list()
+                self.owner = owner
+            if self.idle:
+                return self.idle.pop()
+        return connect_db()
+
+    def put(self, conn):
+        "Hands back a connection obtained from get()"
+        conn.rollback()
+        with self.lock:
+            if self.owner == (os.getpid(), app.config['DATABASE']) and len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+db_pool = ConnectionPool(app.config['DB_POOL_SIZE'])
+
+#-------------------------------------------------------------------------
+def upgrade_db(db):
+    """Brings a sqlite db created from an older schema.sql up to date by
+    creating the tables and adding the columns it is missing. Existing
+    rows are kept, unlike init_db() which drops every table.
+
+    Parameters:
+        ---db = an open sqlite connection
+    """
+    with app.open_resource('schema.sql', mode='r') as f:
+        statements = f.read().split(';')
+
+    for statement in statements:
+        if re.match(r'\s*create index if not exists ', statement):
+            db.execute(statement)
+            continue
+        m = re.search(r'create table (\w+) \((.*)\)', statement, re.S)
+        if m is None:
+            continue
+        table = m.group(1)
+        columns = [row[1] for row in db.execute('pragma table_info(%s)' % table)]
+        if not columns:
+            db.execute(statement)
+            continue
+        #one column definition per line in schema.sql
+        for line in m.group(2).splitlines():
+            definition = line.strip().rstrip(',')
+            if definition and definition.split()[0] not in columns:
+                db.execute('alter table %s add column %s' % (table, definition))
+    db.commit()
+
 #-------------------------------------------------------------------------
 def get_db():
     """Opens a new database connection if there is none yet for the
     current application context."""
     if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = connect_db()
+        g.sqlite_db = db_pool.get()
     return g.sqlite_db
     
 #-------------------------------------------------------------------------
@@ -104,13 +279,198 @@ def initdb_command():
     init_db()
     print('Initialized the database.')
 
+#-------------------------------------------------------------------------
+def import_manifest(source):
+    """Lists the files of a bulk import.
+
+    Parameters:
+        ---source = a directory, whose .jsonld files are imported under
+        their file name, or a json manifest: a list of objects with the
+        path of a file (relative to the manifest) under 'file' and
+        optionally its 'title' and 'description'
+
+    Returns:
+        ---a list of (filetitle, description, path) tuples
+    """
+    if os.path.isdir(source):
+        names = sorted(name for name in os.listdir(source) if allowed_file(name))
+        return [(os.path.splitext(name)[0], 'Imported from %s' % name, os.path.join(source, name))
+            for name in names]
+
+    with open(source) as f:
+        entries = json.load(f)
+    base = os.path.dirname(os.path.abspath(source))
+    files = list()
+    for entry in entries:
+        path = os.path.join(base, entry['file'])
+        title = entry.get('title') or os.path.splitext(os.path.basename(path))[0]
+        files.append((title, entry.get('description') or 'Imported from %s' % entry['file'], path))
+    return files
+
+#-------------------------------------------------------------------------
+@app.cli.command('bulkimport')
+@click.argument('source')
+@click.option('--workers', type=int, default=None, help='Number of import processes, INGEST_WORKERS by default.')
+@click.option('--retries', type=int, default=1, help='How many times a failed file is tried again.')
+@click.option('--batch', type=int, default=50, help='Number of finished files per jsonfiles update.')
+def bulkimport_command(source, workers, retries, batch):
+    """Imports a directory or a json manifest of .jsonld files, parsing
+    them in parallel on a process pool. Files whose title or file name is
+    already taken or that cannot be read are skipped, files that still
+    fail after the retries are marked failed without stopping the import."""
+    db = get_db()
+    taken = set(row[0] for row in db.execute('select filetitle from jsonfiles'))
+    now = datetime.now()
+    tasks = list()
+    sizes = dict()
+    skipped = 0
+    for filetitle, description, path in import_manifest(source):
+        filename = secure_filename(os.path.basename(path))
+        uploadpath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        if filetitle in taken or os.path.exists(uploadpath):
+            print('%s: skipped, the title or file name is already taken.' % filetitle)
+            skipped += 1
+            continue
+        #each copy is recorded at once, a later failure never leaves a copy without its row
+        try:
+            shutil.copyfile(path, uploadpath)
+            db.execute('insert into jsonfiles (filetitle, description, uploadedtime, filename, status) \
+                values (?, ?, ?, ?, ?)', (filetitle, description, now, filename, 'pending'))
+            db.commit()
+        except (IOError, OSError, sqlite3.Error) as e:
+            db.rollback()
+            if os.path.exists(uploadpath):
+                os.remove(uploadpath)
+            print('%s: skipped, cannot import %s: %s' % (filetitle, path, e))
+            skipped += 1
+            continue
+        taken.add(filetitle)
+        sizes[filetitle] = os.path.getsize(uploadpath)
+        tasks.append((filetitle, uploadpath))
+
+    pool = multiprocessing.Pool(processes=workers or app.config['INGEST_WORKERS'])
+    started = time.time()
+    done = list()
+    total = 0
+    imported = failures = 0
+    try:
+        for attempt in range(retries + 1):
+            failed = list()
+            for filetitle, triples, seconds, error in pool.imap_unordered(import_file, tasks):
+                if error is None:
+                    total += triples
+                    imported += 1
+                    done.append(('ready', triples, sizes[filetitle], seconds, filetitle))
+                    print('%s: %d triples in %.2fs (%.0f triples/s)' %
+                        (filetitle, triples, seconds, triples / max(seconds, 1e-6)))
+                elif attempt < retries:
+                    failed.append(filetitle)
+                    print('%s: failed, will retry: %s' % (filetitle, error))
+                else:
+                    failures += 1
+                    done.append(('failed', None, None, None, filetitle))
+                    print('%s: failed, skipped: %s' % (filetitle, error))
+                if len(done) >= batch:
+                    finish_imports(db, done)
+            tasks = [task for task in tasks if task[0] in failed]
+            if not tasks:
+                break
+    finally:
+        pool.close()
+        pool.join()
+        finish_imports(db, done)
+
+    elapsed = time.time() - started
+    print('Imported %d triples from %d files in %.2fs (%.0f triples/s), %d files failed, %d skipped.' %
+        (total, imported, elapsed, total / max(elapsed, 1e-6), failures, skipped))
+
+#-------------------------------------------------------------------------
+def reindex_building(dbname):
+    """Writes the index and, when WRITE_SNAPSHOTS is set, the snapshot of
+    a building from its store, keeping the prefixes of its @context. For
+    buildings ingested before indexes or snapshots were written, or whose
+    index has an older format.
+
+    Returns:
+        ---the number of triples in the building graph
+    """
+    prefixes = read_prefixes(dbname)
+    with building_dataset(dbname) as ds:
+        if ds is None:
+            raise ValueError('No RDF DB exists for %s' % dbname)
+        g4 = ds.get_context(building_graph_uri(dbname))
+        writers = [BuildingIndexWriter(dbname)]
+        if app.config['WRITE_SNAPSHOTS']:
+            writers.append(SnapshotWriter(dbname))
+        try:
+            for writer in writers:
+                writer.add(g4.triples((None, None, None)))
+        except Exception:
+            for writer in writers:
+                writer.abort()
+            raise
+        writers[0].close(prefixes)
+        with span('snapshot_write'):
+            for writer in writers[1:]:
+                writer.close()
+        ts = len(g4)
+    write_prefixes(dbname, prefixes)
+    invalidate_building(dbname)
+    return ts
+
+#-------------------------------------------------------------------------
+@app.cli.command('reindex')
+@click.argument('filetitles', nargs=-1)
+@click.option('--all', 'everything', is_flag=True, help='Also rewrite indexes and snapshots that are up to date.')
+def reindex_command(filetitles, everything):
+    """Writes the index and the snapshot of ready buildings from their
+    stores, so that buildings ingested before they existed, or whose
+    index has an older format, need not be uploaded again. Only the
+    buildings given by title are rewritten, or by default every building
+    missing either of them."""
+    db = get_db()
+    if not filetitles:
+        filetitles = [row[0] for row in
+            db.execute("select filetitle from jsonfiles where status = 'ready' order by filetitle")]
+    else:
+        everything = True
+    for filetitle in filetitles:
+        dbname = '_'.join(filetitle.split())
+        if not store_exists(dbname):
+            print('%s: skipped, it has no store.' % filetitle)
+            continue
+        snapshot = os.path.exists(snapshot_path(dbname)) or not app.config['WRITE_SNAPSHOTS']
+        index = open_index(dbname)
+        if index is not None:
+            index.close()
+            if snapshot and not everything:
+                continue
+        started = time.time()
+        triples = reindex_building(dbname)
+        print('%s: indexed %d triples in %.2fs.' % (filetitle, triples, time.time() - started))
+
+#-------------------------------------------------------------------------
+def finish_imports(db, done):
+    """Writes the status of a batch of imported files to jsonfiles
+
+    Parameters:
+        ---done = list of (status, triplecount, filesize, ingestseconds,
+        filetitle) tuples, emptied once written
+    """
+    if done:
+        db.executemany('update jsonfiles set status = ?, version = version + 1, \
+            triplecount = ?, filesize = ?, ingestseconds = ? where filetitle = (?)', done)
+        db.commit()
+        del done[:]
+
 
 #-------------------------------------------------------------------------
 @app.teardown_appcontext
 def close_db(error):
-    """Closes the database again at the end of the request."""
+    """Hands the database connection back to the pool at the end of the
+    request."""
     if hasattr(g, 'sqlite_db'):
-        g.sqlite_db.close()
+        db_pool.put(g.sqlite_db)
 
 
 #-------------------------------------------------------------------------
@@ -123,14 +483,41 @@ def bad_request_handler():
     return render_template('Bad_Request_400.html')
 
 #-------------------------------------------------------------------------
-def getFiles():
-    """This function fetches all the files uploaded todate
-    from the sqlite db"""
+def files_token(row):
+    "Returns the continuation token of the page of files after row"
+    return base64.urlsafe_b64encode(json.dumps({'uploadedtime': row['uploadedtime'],
+        'filetitle': row['filetitle']}).encode('utf-8')).decode('ascii')
+
+#-------------------------------------------------------------------------
+def getFiles(after=None, limit=None):
+    """This function fetches a page of the files uploaded todate from
+    the sqlite db, newest first. Pages are read from the uploadedtime
+    index by key, not by offset, so every page costs the same.
+
+    Parameters:
+        ---after = optional token returned with the previous page
+        ---limit = page size, FILES_PAGE_SIZE by default
+
+    Returns:
+        ---(the rows of the page, the token of the next page or None)
+    """
+    limit = limit or app.config['FILES_PAGE_SIZE']
+    where = ''
+    params = list()
+    if after:
+        try:
+            key = json.loads(base64.urlsafe_b64decode(after.encode('ascii')).decode('utf-8'))
+            params = [key['uploadedtime'], key['uploadedtime'], key['filetitle']]
+            where = 'where uploadedtime < ? or (uploadedtime = ? and filetitle < ?)'
+        except (ValueError, TypeError, KeyError, UnicodeError):
+            pass
     db = get_db()
-    cur = db.execute('select filetitle, description, \
-        uploadedtime, filename from jsonfiles order by uploadedtime desc')
+    cur = db.execute('select filetitle, description, uploadedtime, filename, status, \
+        triplecount, filesize, ingestseconds from jsonfiles %s \
+        order by uploadedtime desc, filetitle desc limit ?' % where, params + [limit + 1])
     files = cur.fetchall()
-    return files
+    nextpage = files_token(files[limit - 1]) if len(files) > limit else None
+    return files[:limit], nextpage
 
 #-------------------------------------------------------------------------
 @app.route('/', methods=['GET', 'POST'])
@@ -146,8 +533,8 @@ def index():
             return render_template('index.html')
         #if logged_in
         else:
-            files = getFiles()
-            return render_template('index.html', files=files)
+            files, nextpage = getFiles(request.args.get('after'))
+            return render_template('index.html', files=files, nextpage=nextpage)
     
     #for POST requests
     elif request.method == 'POST':
@@ -157,10 +544,10 @@ def index():
                 error = 'Invalid credentials'
                 return render_template('index.html', error=error)
             else:
-                files = getFiles()
+                files, nextpage = getFiles()
                 session['logged_in'] = True
                 session['username'] = app.config['USERNAME']
-                return render_template('index.html', files=files)
+                return render_template('index.html', files=files, nextpage=nextpage)
         #if logged_in
         else:
             return abort(401)
@@ -175,513 +562,4044 @@ def logout():
     session.pop('logged_in', None)
     return redirect(url_for('index'))
 
+#-------------------------------------------------------------------------
+@app.route('/files', methods=['GET'])
+def files():
+    """Returns a page of the uploaded files with their ingest statistics
+
+    Parameters (query):
+        ---after = optional token of the next page, as returned under 'next'
+        ---limit = optional page size
+
+    Returns:
+        ---json with the files of the page and the token of the next page
+    """
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit <= 0:
+        return jsonify(response = 'limit must be a positive integer'), 400
+    rows, nextpage = getFiles(request.args.get('after'), limit)
+    return jsonify(files=[dict(zip(row.keys(), row)) for row in rows], next=nextpage)
+
 #-------------------------------------------------------------------------
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
 #-------------------------------------------------------------------------
-def save_in_sleepycat(dbname, jsonldfilepath):
-    ttl = 'turtle'
-    jld = 'json-ld'
+#upper bounds of the histogram buckets
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
 
-    dbpath = os.path.join(SLEEPYCAT_DB_FOLDER, dbname)
+#-------------------------------------------------------------------------
+class Histogram(object):
+    """A Prometheus histogram with one series per value of its label"""
 
-    ds = rdflib.Dataset(store='Sleepycat', default_union=True)
-    rt = ds.open(dbpath, create=False)
+    def __init__(self, name, doc, label, buckets):
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = OrderedDict()
 
-    if rt == rdflib.store.NO_STORE:
-        ds.open(dbpath, create=True)
-    
-    brickframe = rdflib.URIRef(BRICKFRAME_GRAPH)
-    g1 = ds.graph(brickframe)
-    g1.parse(BRICKFRAME_PATH, format=ttl)
+    def observe(self, value, labelvalue):
+        "Counts one observation of value for the given label value"
+        with self.lock:
+            series = self.series.get(labelvalue)
+            if series is None:
+                series = self.series[labelvalue] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
 
-    #print len(g1)
+    def state(self):
+        "Returns a copy of the series, for merging with those of other processes"
+        with self.lock:
+            return dict((labelvalue, [list(counts), total, count])
+                for labelvalue, (counts, total, count) in self.series.items())
 
-    bricktag = rdflib.URIRef(BRICKTAG_GRAPH)
-    g2 = ds.graph(bricktag)
-    g2.parse(BRICKTAG_PATH, format=ttl)
+    def merge(self, series):
+        "Adds series returned by state(), e.g. by another process, to this histogram"
+        with self.lock:
+            merge_series(self.series, series)
 
-    #print len(g2)
+    def reset(self):
+        "Drops every observation, along with a lock a forked process may have inherited held"
+        self.lock = threading.Lock()
+        self.series = OrderedDict()
 
-    brick = rdflib.URIRef(BRICK_GRAPH)
-    g3 = ds.graph(brick)
-    g3.parse(BRICK_PATH, format=ttl)
+    def render(self, series=None):
+        """Returns the lines of the histogram in the Prometheus text format
 
-    #print len(g3)
+        Parameters:
+            ---series = optional series to render instead of this process's,
+            see merged_metrics()
+        """
+        lines = ['# HELP %s %s' % (self.name, self.doc), '# TYPE %s histogram' % self.name]
+        if series is None:
+            series = self.state()
+        for labelvalue, (counts, total, count) in sorted(series.items()):
+            label = '%s="%s"' % (self.label, labelvalue.replace('\\', '\\\\').replace('"', '\\"'))
+            for bound, n in zip(self.buckets, counts):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, label, repr(float(bound)), n))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, label, count))
+            lines.append('%s_sum{%s} %s' % (self.name, label, repr(total)))
+            lines.append('%s_count{%s} %d' % (self.name, label, count))
+        return lines
 
-    
-    #print uploadedBldg
-    #print uploadedBldg.identifier
+span_seconds = Histogram('jsonldviewer_span_seconds',
+    'Seconds spent in each phase of a request or ingest job.', 'span', TIME_BUCKETS)
+request_seconds = Histogram('jsonldviewer_request_seconds',
+    'Seconds taken by requests, per endpoint.', 'endpoint', TIME_BUCKETS)
+response_bytes = Histogram('jsonldviewer_response_bytes',
+    'Size of response bodies, per endpoint.', 'endpoint', SIZE_BUCKETS)
+result_rows = Histogram('jsonldviewer_result_rows',
+    'Number of rows returned by searches, per endpoint.', 'endpoint', ROW_BUCKETS)
 
-    g4tmp = rdflib.ConjunctiveGraph()
-    g4tmp.parse(jsonldfilepath, format=jld)
+HISTOGRAMS = [request_seconds, span_seconds, response_bytes, result_rows]
 
-    uploadedBldg =rdflib.URIRef(UPLOAD_GRAPH + dbname + 'graph')
-    g4 = ds.graph(uploadedBldg)
+#spans of the request or ingest job running on the current thread
+_spans = threading.local()
 
-    for t in g4tmp.triples((None, None, None)):
-        g4.add(t)
+#-------------------------------------------------------------------------
+def merge_series(into, series):
+    """Adds the series of a histogram, as returned by Histogram.state(),
+    to those in into"""
+    for labelvalue, (counts, total, count) in series.items():
+        merged = into.get(labelvalue)
+        if merged is None:
+            into[labelvalue] = [list(counts), total, count]
+            continue
+        merged[0] = [a + b for a, b in zip(merged[0], counts)]
+        merged[1] += total
+        merged[2] += count
 
-    #print len(g4)
+#-------------------------------------------------------------------------
+def metrics_path(pid):
+    "Returns the file in METRICS_FOLDER holding the histograms of a process"
+    return os.path.join(app.config['METRICS_FOLDER'], '%d.json' % pid)
 
-    #print len(g1) + len(g2) + len(g3) + len(g4)
+#-------------------------------------------------------------------------
+def read_metrics(path):
+    """Returns the histograms written to a metrics file, as a dict from
+    histogram name to its series, or None if it cannot be read"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
 
-    #print len(ds)
-    ts = len(ds)
+#-------------------------------------------------------------------------
+def write_metrics():
+    """Writes the histograms of this process to a file of its own in
+    METRICS_FOLDER, so that the worker answering /metrics can add up those
+    of every worker. Nothing is written when METRICS_FOLDER is not set."""
+    if app.config['METRICS_FOLDER'] is None:
+        return
+    path = metrics_path(os.getpid())
+    tmppath = '%s.%d.tmp' % (path, threading.current_thread().ident)
+    with open(tmppath, 'w') as f:
+        json.dump(dict((histogram.name, histogram.state()) for histogram in HISTOGRAMS), f)
+    os.rename(tmppath, path)
 
-    ds.close()
+#-------------------------------------------------------------------------
+def merged_metrics():
+    """Adds up the histograms written by every process to METRICS_FOLDER,
+    this one included. The histograms of workers that exited are kept by
+    the serve process, see retire_metrics(), so counts never go down.
 
-    return ts
+    Returns:
+        ---dict from histogram name to its merged series
+    """
+    write_metrics()
+    merged = dict((histogram.name, dict()) for histogram in HISTOGRAMS)
+    folder = app.config['METRICS_FOLDER']
+    for filename in os.listdir(folder):
+        if not filename.endswith('.json'):
+            continue
+        states = read_metrics(os.path.join(folder, filename))
+        if states is None:
+            continue
+        for name, series in states.items():
+            if name in merged:
+                merge_series(merged[name], series)
+    return merged
 
 #-------------------------------------------------------------------------
-@app.route('/addfile', methods=['GET', 'POST'])
-def addfile():
-    if request.method == 'GET':
-        if session.get('logged_in'):
-            return render_template('addfile.html')
-        else:
-            return abort(401)
+def retire_metrics(pid):
+    """Moves the histograms of a worker that exited into those of this
+    process and removes its file, before a worker that replaces it starts
+    writing its own. Nothing is done when METRICS_FOLDER is not set."""
+    if app.config['METRICS_FOLDER'] is None:
+        return
+    path = metrics_path(pid)
+    states = read_metrics(path)
+    if states is not None:
+        for histogram in HISTOGRAMS:
+            histogram.merge(states.get(histogram.name, dict()))
+        write_metrics()
+    if os.path.exists(path):
+        os.remove(path)
+
+#-------------------------------------------------------------------------
+def start_spans():
+    "Starts collecting the spans of a request or ingest job on this thread"
+    _spans.current = OrderedDict()
+
+#-------------------------------------------------------------------------
+def finish_spans():
+    """Stops collecting spans on this thread.
+
+    Returns:
+        ---an OrderedDict from span name to the seconds spent in it
+    """
+    current = getattr(_spans, 'current', None)
+    _spans.current = None
+    return current if current is not None else OrderedDict()
+
+#-------------------------------------------------------------------------
+def observe_spans(spans):
+    "Adds the spans of one finished request or job to the span histogram"
+    for name, seconds in spans.items():
+        span_seconds.observe(seconds, name)
 
+#-------------------------------------------------------------------------
+def record_span(name, seconds):
+    """Adds seconds to a span of the current request or job. Work done
+    outside of one, e.g. in a streamed response, is observed right away."""
+    current = getattr(_spans, 'current', None)
+    if current is None:
+        span_seconds.observe(seconds, name)
     else:
-        filefield = 'jsonldfile'
-        if filefield not in request.files:
-            uploadmsg = 'No File was uploaded!'
-            uploadstatus = 'F'
-            return render_template('addfile.html', uploadmsg=uploadmsg, uploadstatus=uploadstatus)
+        current[name] = current.get(name, 0.0) + seconds
 
-        elif request.files[filefield].filename == '' or request.form['filetitle'] == '' or request.form['filedesc'] == '':
-            uploadmsg = 'ERROR! Fields were empty OR No File was selected!'
-            uploadstatus = 'F'
-            return render_template('addfile.html', uploadmsg=uploadmsg, uploadstatus=uploadstatus)
+#-------------------------------------------------------------------------
+@contextmanager
+def span(name):
+    """Times the enclosed block as a span: store_open, schema_parse,
+    jsonld_parse, triple_copy, diff, sparql_prepare, sparql_eval, shorten,
+    search or serialize. Spans may nest, search includes the spans of the
+    search itself."""
+    started = time.time()
+    try:
+        yield
+    finally:
+        record_span(name, time.time() - started)
 
-        elif not allowed_file(request.files[filefield].filename):
-            uploadmsg = 'ERROR! Wrong file format'
-            uploadstatus = 'F'
-            return render_template('addfile.html', uploadmsg=uploadmsg, uploadstatus=uploadstatus)
+#-------------------------------------------------------------------------
+@app.before_request
+def start_request_spans():
+    g.started = time.time()
+    start_spans()
 
-        else:
-            uploadedfile = request.files[filefield]
-            uploadedfilename = secure_filename(uploadedfile.filename)
-            uploadedfilesavepath = os.path.join(app.config['UPLOAD_FOLDER'], uploadedfilename)
-            if os.path.exists(uploadedfilesavepath):
-                uploadmsg = 'ERROR! A file with the same name already exists'
-                uploadstatus = 'F'
-                return render_template('addfile.html', uploadmsg=uploadmsg, uploadstatus=uploadstatus)
-            
-            db = get_db()
-            cur = db.execute('select filetitle from jsonfiles where filetitle = (?)', (request.form['filetitle'],))
-            result = cur.fetchone()
-            if result == request.form['filetitle']:
-                uploadmsg = 'ERROR! Duplicate File title'
-                uploadstatus = 'F'
-                return render_template('addfile.html', uploadmsg=uploadmsg, uploadstatus=uploadstatus)
+#-------------------------------------------------------------------------
+@app.after_request
+def finish_request_spans(response):
+    """Records the latency, size and spans of a request. A request sent
+    with an X-Profile header gets its spans back in a Server-Timing
+    header, in milliseconds. Spans of a streamed body are not included,
+    it is produced after the headers are sent."""
+    spans = finish_spans()
+    observe_spans(spans)
+    endpoint = request.endpoint or 'unknown'
+    elapsed = time.time() - g.started
+    request_seconds.observe(elapsed, endpoint)
+    if not response.is_streamed and response.content_length is not None:
+        response_bytes.observe(response.content_length, endpoint)
 
-            #all is ok
-            #uploadedfilesavepath = os.path.join(app.config['UPLOAD_FOLDER'], uploadedfilename)
-            uploadedfile.save(uploadedfilesavepath)
+    if request.headers.get('X-Profile'):
+        timings = ['%s;dur=%.3f' % (name, seconds * 1000) for name, seconds in spans.items()]
+        timings.append('total;dur=%.3f' % (elapsed * 1000))
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
 
-            db = get_db()
-            db.execute('insert into jsonfiles (filetitle, description, uploadedtime, filename) values (?, ?, ?, ?)', \
-                    (request.form['filetitle'], request.form['filedesc'], datetime.now(), uploadedfilename))
-            db.commit()
+#-------------------------------------------------------------------------
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Returns the histograms in the Prometheus text format: those of this
+    process, or added up over every worker when METRICS_FOLDER is set, as
+    it is by the serve command"""
+    merged = merged_metrics() if app.config['METRICS_FOLDER'] is not None else dict()
+    lines = list()
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render(merged.get(histogram.name)))
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
 
-            uploadmsg = 'File Upload Successful'
-            uploadstatus = 'T'
 
-            #save it in sleepycat db
-            dbname = '_'.join(request.form['filetitle'].split())
-            triples = save_in_sleepycat(dbname=dbname, jsonldfilepath=uploadedfilesavepath)
+#-------------------------------------------------------------------------
+#shared schema store : opened once per process
+_schema_store = None
+_schema_lock = threading.Lock()
 
-            return render_template('addfile.html', uploadmsg=uploadmsg, uploadstatus=uploadstatus, triplecount=triples)
+#-------------------------------------------------------------------------
+def schema_digest():
+    """Returns a sha1 hex digest over the graph URIs and the contents of
+    the Brick schema files, used to decide whether the shared schema
+    store is still up to date"""
+    h = hashlib.sha1()
+    for graphuri, path in SCHEMA_GRAPHS:
+        h.update(graphuri.encode('utf-8'))
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+    return h.hexdigest()
 
+#-------------------------------------------------------------------------
+def stored_schema_digest():
+    """Returns the digest the shared schema store was built from, or None
+    if there is no usable store on disk"""
+    digestpath = os.path.join(SCHEMA_DB_FOLDER, SCHEMA_DIGEST_FILE)
+    if not os.path.exists(digestpath):
+        return None
+    with open(digestpath) as f:
+        return f.read().strip()
 
-#-------------------------------------------------------------------------     
-@app.route('/viewer/<filetitle>', methods=['GET'])
-def viewer(filetitle):
-    """Displays the viewer main page
+#-------------------------------------------------------------------------
+def build_schema_store(digest):
+    """Parses the Brick schema files from turtle into a fresh Sleepycat
+    store and swaps it in place of SCHEMA_DB_FOLDER.
 
     Parameters:
-        ---filetitle = the title of the file to be opened in viewer
+        ---digest = the schema_digest() of the files being parsed
 
     Returns:
-        ---the viewer template passing the entire file information and the actual
-        jsonld file content
+        ---the number of schema triples in the new store
     """
+    #builds in a private folder so that a half written store is never opened
+    tmppath = '%s.%d.tmp' % (SCHEMA_DB_FOLDER, os.getpid())
+    if os.path.exists(tmppath):
+        shutil.rmtree(tmppath)
 
-    #gets sqlite db connection instance
-    db = get_db()
+    ds = rdflib.Dataset(store=rdf_store_name)
+    ds.open(tmppath, create=True)
+    with span('schema_parse'):
+        for graphuri, path in SCHEMA_GRAPHS:
+            ds.graph(rdflib.URIRef(graphuri)).parse(path, format=sf_ttl)
+    ts = len(ds)
+    ds.close()
 
-    #executes query to fetch details of using filetitle
-    cur = db.execute('select filetitle, description, \
-            uploadedtime, filename from jsonfiles where filetitle = (?)', (filetitle,))
-    result = cur.fetchone()
+    #the digest file is written last, it marks the store as complete
+    with open(os.path.join(tmppath, SCHEMA_DIGEST_FILE), 'w') as f:
+        f.write(digest)
 
+    if os.path.exists(SCHEMA_DB_FOLDER):
+        shutil.rmtree(SCHEMA_DB_FOLDER, ignore_errors=True)
+    try:
+        os.rename(tmppath, SCHEMA_DB_FOLDER)
+    except OSError:
+        #another process finished its build first, keep that one
+        shutil.rmtree(tmppath, ignore_errors=True)
 
-    #initialize rdf graph and send json to template
+    return ts
 
-    ##extracts the file name
-    filename = result[3]
+#-------------------------------------------------------------------------
+def get_schema_store():
+    """Returns the process wide dataset holding the Brick schema graphs.
+    The store is (re)built from the turtle files only when their digest
+    differs from the one it was built from, so the schema is parsed once
+    instead of on every upload. It must be treated as read-only."""
+    global _schema_store
+    with _schema_lock:
+        if _schema_store is None and shared_storage():
+            ds = get_shared_store()
+            load_shared_schema(ds)
+            _schema_store = ds
+        if _schema_store is None:
+            digest = schema_digest()
+            if stored_schema_digest() != digest:
+                build_schema_store(digest)
+            ds = rdflib.Dataset(store=rdf_store_name)
+            with span('store_open'):
+                rt = ds.open(SCHEMA_DB_FOLDER, create=False)
+            if rt == rdflib.store.NO_STORE:
+                #the digest is there but not the store, e.g. a partly removed folder
+                build_schema_store(digest)
+                with span('store_open'):
+                    rt = ds.open(SCHEMA_DB_FOLDER, create=False)
+            if rt == rdflib.store.NO_STORE:
+                raise ValueError('Cannot open the schema store in %s' % SCHEMA_DB_FOLDER)
+            _schema_store = ds
+        return _schema_store
 
-    #creates file path
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+#-------------------------------------------------------------------------
+#shared quad store : opened once per process, only used in shared mode
+_shared_store = None
+_shared_lock = threading.Lock()
 
-    #opens the jsonld file and reads the contents into memory
-    with open(filepath) as jsonld_data:
-        d = json.load(jsonld_data)
-        j = json.dumps(d, indent=4)
-        
-    #returns the viewer page with the necessary data
-    return render_template('viewer.html', fileinfo=result, jsonld=j)
+#-------------------------------------------------------------------------
+def shared_storage():
+    """Returns True when every building lives as a named graph of the one
+    shared store instead of in a Sleepycat store of its own"""
+    return app.config['STORAGE_MODE'] == 'shared'
 
 #-------------------------------------------------------------------------
-@app.route('/delete/<filetitle>', methods=['GET'])
-def delete(filetitle):
-    """Deletes a jsonld file and also its associated SQLite DB entry
-    and the Sleepycat RDF Database
+def get_shared_store():
+    """Returns the process wide dataset of the shared store, holding the
+    named graph of every building and a single copy of the schema graphs"""
+    global _shared_store
+    with _shared_lock:
+        if _shared_store is None:
+            ds = rdflib.Dataset(store=rdf_store_name, default_union=True)
+            with span('store_open'):
+                ds.open(SHARED_DB_FOLDER, create=True)
+            _shared_store = ds
+        return _shared_store
+
+#-------------------------------------------------------------------------
+def load_shared_schema(ds):
+    """Reloads the schema graphs of the shared store from the turtle
+    files when they changed since the last load.
 
     Parameters:
-        ---filetitle = the title of the file to be deleted
+        ---ds = the dataset returned by get_shared_store()
 
     Returns:
-        ---Redirects to Index view with a response code and a response message
+        ---the number of schema triples loaded, 0 when it was up to date
     """
-    #gets db connection instance
-    db = get_db()
+    digest = schema_digest()
+    digestpath = os.path.join(SHARED_DB_FOLDER, SCHEMA_DIGEST_FILE)
+    if os.path.exists(digestpath):
+        with open(digestpath) as f:
+            if f.read().strip() == digest:
+                return 0
 
-    #executes query to fetch details of using filetitle
-    cur = db.execute('select filetitle, description, \
-        uploadedtime, filename from jsonfiles where filetitle = (?)', (filetitle,))
-    result = cur.fetchone()
-    
-    #extracts the file name
-    filename = result[3]
+    ts = 0
+    with span('schema_parse'):
+        for graphuri, path in SCHEMA_GRAPHS:
+            ds.remove_graph(rdflib.URIRef(graphuri))
+            graph = ds.graph(rdflib.URIRef(graphuri))
+            graph.parse(path, format=sf_ttl)
+            ts += len(graph)
 
-    #creates file path
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    with open(digestpath, 'w') as f:
+        f.write(digest)
+    return ts
 
-    #removes file using file path
-    os.remove(filepath)
+#-------------------------------------------------------------------------
+def store_path(dbname):
+    "Returns the folder of the Sleepycat store holding a building's graph"
+    if shared_storage():
+        return SHARED_DB_FOLDER
+    return os.path.join(SLEEPYCAT_DB_FOLDER, dbname)
 
-    #deletes entry of file from sqlite database
-    db.execute('delete from jsonfiles where filetitle = (?)', (filetitle,))
-    db.commit()
+#-------------------------------------------------------------------------
+def file_identity(path):
+    """Returns what tells one version of a file or folder from another,
+    also across processes: its inode, change and modification times and
+    size, or None when it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_ctime, st.st_mtime, st.st_size)
 
-    #creates path to sleepycat database for this file
-    SLEEPYCAT_DB_PATH = os.path.join(SLEEPYCAT_DB_FOLDER, '_'.join(filetitle.split()))
+#-------------------------------------------------------------------------
+def building_exists(dbname):
+    """Returns True if the building can be read: it has a snapshot, see
+    building_graph(), or a store"""
+    return os.path.exists(snapshot_path(dbname)) or store_exists(dbname)
 
-    #removes entire directory containing sleepycat database
-    shutil.rmtree(SLEEPYCAT_DB_PATH, ignore_errors=False)
+#-------------------------------------------------------------------------
+def store_exists(dbname):
+    """Returns True if there is a store for the building: its own folder,
+    or a non-empty named graph of the shared store"""
+    if shared_storage():
+        graph = get_shared_store().get_context(building_graph_uri(dbname))
+        return next(graph.triples((None, None, None)), None) is not None
+    return os.path.exists(os.path.join(SLEEPYCAT_DB_FOLDER, dbname))
 
-    return redirect(url_for('index'))
+#-------------------------------------------------------------------------
+def schema_graphs():
+    """Returns the BrickFrame, BrickTag and Brick graphs of the shared
+    schema store"""
+    ds = get_schema_store()
+    return [ds.get_context(rdflib.URIRef(graphuri)) for graphuri, path in SCHEMA_GRAPHS]
 
+#-------------------------------------------------------------------------
+def building_graph_uri(dbname):
+    "Returns the named graph URI under which a building's triples are stored"
+    return rdflib.URIRef(UPLOAD_GRAPH + dbname + 'graph')
 
 #-------------------------------------------------------------------------
-@app.route('/getNamespaceURIs', methods=['POST'])
-def getNamespaceURIs():
-    d = dict()
-    d['rdf'] = rdf_uri
-    d['rdfs'] = rdfs_uri
-    d['owl'] = owl_uri
-    d['skos'] = skos_uri
-    d['bf'] = brickframe_uri
-    d['tag'] = bricktag_uri
-    d['brick'] = brick_uri
-    d['site'] = site_uri
-    return jsonify(d)
+class UnionGraph(rdflib.graph.ReadOnlyGraphAggregate):
+    """Read-only union of several graphs that, unlike its base class,
+    evaluates a property path once over the whole union instead of once
+    per member graph, and yields a triple held by several members once"""
 
-#--------------------------------------------------------------------------
-def shortenURI(uri):
-    if re.search(rdf_uri, uri):
-        return re.sub(rdf_uri, 'rdf:', uri)
-    elif re.search(rdfs_uri, uri):
-        return re.sub(rdfs_uri, 'rdfs:', uri)
-    elif re.search(owl_uri, uri):
-        return re.sub(owl_uri, 'owl:', uri)
-    elif re.search(skos_uri, uri):
-        return re.sub(skos_uri, 'skos:', uri)
-    elif re.search(brickframe_uri, uri):
-        return re.sub(brickframe_uri, 'bf:', uri)
-    elif re.search(bricktag_uri, uri):
-        return re.sub(bricktag_uri, 'tag:', uri)
-    elif re.search(brick_uri, uri):
-        return re.sub(brick_uri, 'brick:', uri)
-    elif re.search(site_uri, uri):
-        return re.sub(site_uri, 'site:', uri)
-    else:
-        return uri
-        
+    def triples(self, triple):
+        s, p, o = triple
+        if isinstance(p, rdflib.paths.Path):
+            for s1, o1 in p.eval(self, s, o):
+                yield s1, p, o1
+            return
+        for i, graph in enumerate(self.graphs):
+            for t in graph.triples((s, p, o)):
+                if not any(t in earlier for earlier in self.graphs[:i]):
+                    yield t
 
-#-------------------------------------------------------------------------------
-@app.route('/searchByClass', methods=['POST'])
-def searchByClass():
-    BRICKFRAME = rdflib.Namespace('http://buildsys.org/ontologies/BrickFrame#')
-    BRICK = rdflib.Namespace('http://buildsys.org/ontologies/Brick#')
-    BRICKTAG = rdflib.Namespace('http://buildsys.org/ontologies/BrickTag#')
-    SITE = rdflib.Namespace('http://jci.buildings.org/ontology/carsongulley#')
-    SKOS = rdflib.Namespace('http://www.w3.org/2004/02/skos/core#')
+#-------------------------------------------------------------------------
+def with_schema(graph, deadline=None):
+    """Returns a read-only view over a building graph together with the
+    shared schema graphs, for queries that need the Brick class hierarchy
 
-    filetitle = '_'.join(request.json['filetitle'].split())
-    brickclass = 'brick:' + request.json['brickClass']
+    Parameters:
+        ---deadline = optional time after which reading the view raises
+        DeadlineExceeded, see DeadlineGraph
+    """
+    if deadline is not None:
+        return DeadlineGraph([graph] + schema_graphs(), deadline)
+    return UnionGraph([graph] + schema_graphs())
 
-    dbpath = os.path.join(SLEEPYCAT_DB_FOLDER, filetitle)
-    ds = rdflib.Dataset(store='Sleepycat', default_union=True)
-    rt = ds.open(dbpath, create=False)
-    if rt == rdflib.store.NO_STORE:
-        return jsonify(response = 'No RDF DB exists')
-        
-    queryString = """SELECT ?s WHERE {
-                ?s rdf:type ?o.
-                ?o rdfs:subClassOf* %s.
-                }""" % (brickclass,)    
-
-    # elif brickclass == 'location':
-    #     queryString = """SELECT ?s WHERE {
-    #             ?s rdf:type ?o.
-    #             ?o rdfs:subClassOf* brick:Location.
-    #             }"""
-
-    # elif brickclass == 'point':
-    #     queryString = """SELECT ?s WHERE {
-    #             ?s rdf:type ?o.
-    #             ?o rdfs:subClassOf* brick:Point.
-    #             }"""
-        
-    print queryString
-    q = prepareQuery(queryString, initNs={'brick':BRICK, 'rdf':rdflib.RDF, 'rdfs':rdflib.RDFS, 'site':SITE})
-    queryResult = ds.query(q)
-        
-    print len(queryResult)
-
-                
-    d = list()
-            
-    for row in queryResult:
-        tmp = shortenURI(row['s'])            
-        d.append(tmp)
-                        
-    ds.close()
-    return jsonify(d)
+#-------------------------------------------------------------------------
+class CachedDataset(object):
+    "An open building dataset together with its users and last use time"
 
+    def __init__(self, dbname, ds, identity=None):
+        self.dbname = dbname
+        self.ds = ds
+        self.identity = identity
+        self.users = 0
+        self.lastused = time.time()
+        self.retired = False
 
-#---------------------------------------------------------------------------------------------
-@app.route('/customSearch', methods=['POST'])
-def customSearch():
-    BRICKFRAME = rdflib.Namespace('http://buildsys.org/ontologies/BrickFrame#')
-    BRICK = rdflib.Namespace('http://buildsys.org/ontologies/Brick#')
-    BRICKTAG = rdflib.Namespace('http://buildsys.org/ontologies/BrickTag#')
-    SITE = rdflib.Namespace('http://jci.buildings.org/ontology/carsongulley#')
-    SKOS = rdflib.Namespace('http://www.w3.org/2004/02/skos/core#')
+#-------------------------------------------------------------------------
+class DatasetCache(object):
+    """Process wide cache of open building datasets keyed by building.
 
-    filetitle = '_'.join(request.json['filetitle'].split())
-    searchTerm = request.json['searchTerm']
-    selectedPosition = request.json['selectedPosition']
+    At most maxopen datasets are kept open, least recently used ones are
+    evicted first and datasets unused for idletimeout seconds are closed
+    on the next acquire(). A dataset that is evicted or invalidated while
+    a request is still using it is closed when that request releases it.
+    A dataset whose store folder was replaced, possibly by another
+    process, is reopened.
 
-    dbpath = os.path.join(SLEEPYCAT_DB_FOLDER, filetitle)
-    ds = rdflib.Dataset(store='Sleepycat', default_union=True)
-    rt = ds.open(dbpath, create=False)
-    if rt == rdflib.store.NO_STORE:
-        return jsonify(response = 'No RDF DB exists')
-    
-    graph_uri = rdflib.URIRef(UPLOAD_GRAPH + '_'.join(filetitle.split()) + 'graph')
-    #print graph_uri
-
-    # for c in ds.graphs():
-    #     print c.identifier
-    #     if str(c.identifier).startswith('http'):
-    #         g = ds.graph(rdflib.URIRef(c.identifier))
-    #         print len(g)
-    
-    graph = ds.graph(graph_uri)
-    #print len(graph)
-    if selectedPosition == 'subject':
-        queryString = """SELECT ?s ?p ?o ?c WHERE {
-                ?s ?p ?o.
-                FILTER(regex(str(?s), "%s", "i"))
-                }""" % (searchTerm,)
-        q = prepareQuery(queryString, initNs={'brick':BRICK, 'rdf':rdflib.RDF, 'rdfs':rdflib.RDFS, 'site':SITE})
-        queryResult = graph.query(q)
-            
-        d = dict()
+    Stores are opened outside of the cache lock, so that opening a large
+    building does not hold up requests on the others. Requests for a
+    building that is being opened wait for that open instead of opening
+    it a second time.
+    """
 
-        d['type'] = 'subject'
-        d['result'] = list()
-        
-        for row in queryResult:
-            tmp = dict()
-            if row['s']:
-                tmp['s'] = shortenURI(row['s'])
-            else:
-                tmp['s'] = ''
-            
-            if row['p']:
-                tmp['p'] = shortenURI(row['p'])
-            else:
-                tmp['p'] = ''
-            
-            if row['o']:
-                tmp['o'] = shortenURI(row['o'])
-            else:
-                tmp['o'] = ''
-            d['result'].append(tmp)
+    def __init__(self, maxopen, idletimeout):
+        self.maxopen = maxopen
+        self.idletimeout = idletimeout
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        #events of the buildings being opened, set once the open is done
+        self.opening = dict()
+        #buildings invalidated while being opened, not to be cached
+        self.stale = set()
 
-        return jsonify(d)
+    def acquire(self, dbname):
+        """Returns the CachedDataset of a building, opening it if needed,
+        or None if the building has no store. Every successful acquire()
+        must be paired with a release()."""
+        path = os.path.join(SLEEPYCAT_DB_FOLDER, dbname)
+        while True:
+            identity = file_identity(path)
+            with self.lock:
+                self._expire()
+                entry = self.entries.pop(dbname, None)
+                if entry is not None and entry.identity != identity:
+                    self._retire(entry)
+                    entry = None
+                if entry is not None:
+                    return self._use(entry)
+                opened = self.opening.get(dbname)
+                if opened is None:
+                    opened = self.opening[dbname] = threading.Event()
+                    break
+            #another request is opening the building, its dataset is then cached
+            opened.wait()
 
-    elif selectedPosition == 'property':
-        queryString = """SELECT ?s ?p ?o WHERE {
-                ?s ?p ?o.
-                FILTER(regex(str(?p), "%s", "i"))
-                }""" % (searchTerm,)
-        q = prepareQuery(queryString, initNs={'brick':BRICK, 'rdf':rdflib.RDF, 'rdfs':rdflib.RDFS, 'site':SITE})
-        queryResult = graph.query(q)
+        try:
+            ds = rdflib.Dataset(store=rdf_store_name, default_union=True)
+            with span('store_open'):
+                rt = ds.open(path, create=False)
+        except Exception:
+            with self.lock:
+                self._opened(dbname, opened)
+            raise
 
-        d = dict()
+        with self.lock:
+            stale = self._opened(dbname, opened)
+            if rt == rdflib.store.NO_STORE:
+                return None
+            entry = CachedDataset(dbname, ds, identity)
+            if stale:
+                #opened before it was invalidated, it serves this request only
+                entry.retired = True
+                entry.users += 1
+                return entry
+            #cached before the waiting requests look again
+            return self._use(entry)
 
-        d['type'] = 'property'
-        d['result'] = list()
-        
-        tmp = dict()
-        for row in queryResult:
-            tmp = dict()
-            if row['s']:
-                tmp['s'] = shortenURI(row['s'])
-            else:
-                tmp['s'] = ''
-            
-            if row['p']:
-                tmp['p'] = shortenURI(row['p'])
-            else:
-                tmp['p'] = ''
-            
-            if row['o']:
-                tmp['o'] = shortenURI(row['o'])
-            else:
-                tmp['o'] = ''
-            d['result'].append(tmp)
+    def _opened(self, dbname, opened):
+        """Ends the open of a building and wakes the requests waiting for
+        it, returns True if it was invalidated in the meantime. Called
+        with the lock held."""
+        del self.opening[dbname]
+        stale = dbname in self.stale
+        self.stale.discard(dbname)
+        opened.set()
+        return stale
 
-        return jsonify(d)
+    def _use(self, entry):
+        "Counts a user of an entry and makes it the most recently used one"
+        entry.users += 1
+        #most recently used entries are kept at the end
+        self.entries[entry.dbname] = entry
+        while len(self.entries) > self.maxopen:
+            self._retire(self.entries.popitem(last=False)[1])
+        return entry
 
-    elif selectedPosition == 'object':
-        queryString = """SELECT ?s ?p ?o WHERE {
-                ?s ?p ?o.
-                FILTER(regex(str(?o), "%s", "i"))
-                }""" % (searchTerm,)
-        q = prepareQuery(queryString, initNs={'brick':BRICK, 'rdf':rdflib.RDF, 'rdfs':rdflib.RDFS, 'site':SITE})
-        queryResult = graph.query(q)
+    def release(self, entry):
+        "Hands back a dataset obtained from acquire()"
+        with self.lock:
+            entry.users -= 1
+            entry.lastused = time.time()
+            if entry.retired and entry.users == 0:
+                entry.ds.close()
 
-        d = dict()
+    def invalidate(self, dbname):
+        """Drops the cached dataset of a building, to be called before its
+        store is rewritten or removed"""
+        with self.lock:
+            entry = self.entries.pop(dbname, None)
+            if entry is not None:
+                self._retire(entry)
+            if dbname in self.opening:
+                self.stale.add(dbname)
 
-        d['type'] = 'object'
-        d['result'] = list()
-        
-        tmp = dict()
-        for row in queryResult:
-            tmp = dict()
-            if row['s']:
-                tmp['s'] = shortenURI(row['s'])
-            else:
-                tmp['s'] = ''
-            
-            if row['p']:
-                tmp['p'] = shortenURI(row['p'])
-            else:
-                tmp['p'] = ''
-            
-            if row['o']:
-                tmp['o'] = shortenURI(row['o'])
-            else:
-                tmp['o'] = ''
-            d['result'].append(tmp)
+    def clear(self):
+        "Drops every cached dataset"
+        with self.lock:
+            while self.entries:
+                self._retire(self.entries.popitem()[1])
+            self.stale.update(self.opening)
 
-        return jsonify(d)
+    def _retire(self, entry):
+        entry.retired = True
+        if entry.users == 0:
+            entry.ds.close()
 
-    elif selectedPosition == 'all':
-        queryString1 = """SELECT ?s ?p ?o WHERE {
-                ?s ?p ?o.
-                FILTER(regex(str(?s), "%s", "i"))
-                }""" % (searchTerm,)
-        q1 = prepareQuery(queryString1, initNs={'brick':BRICK, 'rdf':rdflib.RDF, 'rdfs':rdflib.RDFS, 'site':SITE})
-        queryResult1 = graph.query(q1)
-
-        queryString2 = """SELECT ?s ?p ?o WHERE {
-                ?s ?p ?o.
-                FILTER(regex(str(?p), "%s", "i"))
-                }""" % (searchTerm,)
-        q2 = prepareQuery(queryString2, initNs={'brick':BRICK, 'rdf':rdflib.RDF, 'rdfs':rdflib.RDFS, 'site':SITE})
-        queryResult2 = graph.query(q2)
-
-
-        queryString3 = """SELECT ?s ?p ?o WHERE {
-                ?s ?p ?o.
-                FILTER(regex(str(?o), "%s", "i"))
-                }""" % (searchTerm,)
-        q3 = prepareQuery(queryString3, initNs={'brick':BRICK, 'rdf':rdflib.RDF, 'rdfs':rdflib.RDFS, 'site':SITE})
-        queryResult3 = graph.query(q3)
+    def _expire(self):
+        now = time.time()
+        for dbname, entry in list(self.entries.items()):
+            if entry.users == 0 and now - entry.lastused > self.idletimeout:
+                self._retire(self.entries.pop(dbname))
 
-        d = dict()
+dataset_cache = DatasetCache(app.config['DATASET_CACHE_SIZE'], app.config['DATASET_IDLE_TIMEOUT'])
 
-        d['type'] = 'all'
-        d['result'] = dict()
-        d['result']['subjectwise'] = list()
-        d['result']['propertywise'] = list()
-        d['result']['objectwise'] = list()
-        
-        for row in queryResult1:
-            tmp = dict()
-            if row['s']:
-                tmp['s'] = shortenURI(row['s'])
-            else:
-                tmp['s'] = ''
-            
-            if row['p']:
-                tmp['p'] = shortenURI(row['p'])
-            else:
-                tmp['p'] = ''
-            
-            if row['o']:
-                tmp['o'] = shortenURI(row['o'])
-            else:
-                tmp['o'] = ''
-            d['result']['subjectwise'].append(tmp)
+#-------------------------------------------------------------------------
+class ResultCache(object):
+    """Bounded cache of search results keyed by (building, endpoint,
+    normalized parameters, dataset version).
 
-        for row in queryResult2:
-            tmp = dict()
-            if row['s']:
-                tmp['s'] = shortenURI(row['s'])
-            else:
-                tmp['s'] = ''
-            
-            if row['p']:
-                tmp['p'] = shortenURI(row['p'])
+    At most maxentries results are kept, least recently used first out,
+    entries expire after ttl seconds, and results longer than maxrows
+    rows are never cached so that memory use stays bounded. A result is
+    cached while it is delivered, so a miss costs no more rows than the
+    response needs, and only once it was delivered whole.
+    """
+
+    def __init__(self, maxentries, ttl, maxrows):
+        self.maxentries = maxentries
+        self.ttl = ttl
+        self.maxrows = maxrows
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def rows(self, key, produce):
+        """Returns a generator over the rows cached under key, or over the
+        rows of produce() when there are none, caching them if they fit.
+
+        Parameters:
+            ---key = a tuple whose first item is the building's dbname
+            ---produce = callable returning a generator of result rows
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and time.time() - entry[0] <= self.ttl:
+                self.entries[key] = entry
+                self.hits += 1
+                return self.replay(entry[1])
+            self.misses += 1
+
+        return self.fill(key, produce())
+
+    def replay(self, rows):
+        for row in rows:
+            yield row
+
+    def fill(self, key, rows):
+        """Yields the rows of a generator and caches them under key once
+        it is exhausted, unless there were more than maxrows of them. A
+        consumer that stops early, e.g. after a page, leaves nothing cached."""
+        head = list()
+        try:
+            for row in rows:
+                if head is not None:
+                    head.append(row)
+                    if len(head) > self.maxrows:
+                        head = None
+                yield row
+        finally:
+            rows.close()
+
+        if head is not None:
+            with self.lock:
+                self.entries[key] = (time.time(), head)
+                while len(self.entries) > self.maxentries:
+                    self.entries.popitem(last=False)
+
+    def invalidate(self, dbname):
+        "Drops every cached result of a building"
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == dbname]:
+                del self.entries[key]
+
+    def stats(self):
+        "Returns the hit and miss counters and the number of cached results"
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self.entries))
+
+result_cache = ResultCache(app.config['RESULT_CACHE_SIZE'], app.config['RESULT_CACHE_TTL'],
+    app.config['RESULT_CACHE_MAX_ROWS'])
+
+#-------------------------------------------------------------------------
+def invalidate_building(dbname):
+    """Drops the cached dataset and cached search results of a building,
+    to be called whenever its store is rewritten or removed"""
+    dataset_cache.invalidate(dbname)
+    result_cache.invalidate(dbname)
+    term_index_cache.invalidate(dbname)
+    _building_compactors.pop(dbname, None)
+    with _snapshots_lock:
+        _snapshots.pop(dbname, None)
+
+#-------------------------------------------------------------------------
+@contextmanager
+def building_dataset(dbname):
+    """Context manager over the cached dataset of a building.
+
+    Parameters:
+        ---dbname = the folder name of the building's store
+
+    Returns:
+        ---the open rdflib.Dataset, or None if the building has no store.
+        In shared mode this is the shared store, holding other buildings
+        too, so callers must stay within building_graph_uri(dbname).
+    """
+    if shared_storage():
+        yield get_shared_store() if store_exists(dbname) else None
+        return
+
+    entry = dataset_cache.acquire(dbname)
+    try:
+        yield entry.ds if entry is not None else None
+    finally:
+        if entry is not None:
+            dataset_cache.release(entry)
+
+#-------------------------------------------------------------------------
+@app.cli.command('initschema')
+def initschema_command():
+    """Builds the shared Brick schema store ahead of the first upload or
+    search."""
+    if shared_storage():
+        ts = load_shared_schema(get_shared_store())
+        if ts:
+            print('Loaded %d schema triples into the shared store.' % ts)
+        else:
+            print('Schema graphs of the shared store are up to date.')
+        return
+
+    digest = schema_digest()
+    if stored_schema_digest() == digest:
+        print('Schema store is up to date.')
+    else:
+        ts = build_schema_store(digest)
+        print('Built the schema store with %d triples.' % ts)
+
+#-------------------------------------------------------------------------
+@app.cli.command('migratestores')
+@click.option('--remove', is_flag=True, help='Remove each per-building store once it is copied.')
+def migratestores_command(remove):
+    """Folds the per-building Sleepycat stores into the shared store used
+    when STORAGE_MODE is 'shared'. Only the building graphs are copied, the
+    shared store keeps a single copy of the schema graphs."""
+    shared = get_shared_store()
+    ts = load_shared_schema(shared)
+    if ts:
+        print('Loaded %d schema triples into the shared store.' % ts)
+
+    batchsize = app.config['INGEST_BATCH_SIZE']
+    folders = sorted(os.listdir(SLEEPYCAT_DB_FOLDER)) if os.path.exists(SLEEPYCAT_DB_FOLDER) else []
+    for dbname in folders:
+        dbpath = os.path.join(SLEEPYCAT_DB_FOLDER, dbname)
+        ds = rdflib.Dataset(store=rdf_store_name)
+        if not os.path.isdir(dbpath) or ds.open(dbpath, create=False) == rdflib.store.NO_STORE:
+            continue
+
+        #a rerun replaces what an earlier run copied
+        uploadedBldg = building_graph_uri(dbname)
+        shared.remove_graph(uploadedBldg)
+        target = shared.graph(uploadedBldg)
+        written = 0
+        triples = ds.get_context(uploadedBldg).triples((None, None, None))
+        while True:
+            batch = list(itertools.islice(triples, batchsize))
+            if not batch:
+                break
+            target.addN((s, p, o, target) for s, p, o in batch)
+            written += len(batch)
+        ds.close()
+
+        invalidate_building(dbname)
+        if remove:
+            shutil.rmtree(dbpath)
+        print('%s: copied %d triples.' % (dbname, written))
+
+#-------------------------------------------------------------------------
+#class hierarchy of the shared schema : built once per process
+_class_hierarchy = None
+
+#-------------------------------------------------------------------------
+class ClassHierarchy(object):
+    """Materialized rdfs:subClassOf closure of the Brick schema graphs.
+    descendants maps every class to the set of its transitive subclasses,
+    the class itself included, and schema_types maps classes to the
+    instances typed with them inside the schema graphs."""
+
+    def __init__(self, graphs):
+        self.children = dict()
+        self.parents = dict()
+        self.schema_types = dict()
+        for graph in graphs:
+            for sub, sup in graph.subject_objects(rdflib.RDFS.subClassOf):
+                if isinstance(sub, rdflib.URIRef) and isinstance(sup, rdflib.URIRef):
+                    self.children.setdefault(text_type(sup), set()).add(text_type(sub))
+                    self.parents.setdefault(text_type(sub), set()).add(text_type(sup))
+            for s, o in graph.subject_objects(rdflib.RDF.type):
+                self.schema_types.setdefault(text_type(o), set()).add(text_type(s))
+
+        self.descendants = dict()
+        for cls in self.children:
+            self.descendants[cls] = frozenset(self.walk(cls, self.children))
+
+    def walk(self, cls, children):
+        "Returns cls and every class reachable from it through children"
+        seen = set([cls])
+        stack = [cls]
+        while stack:
+            for sub in children.get(stack.pop(), ()):
+                if sub not in seen:
+                    seen.add(sub)
+                    stack.append(sub)
+        return seen
+
+    def subclasses(self, cls, extra=()):
+        """Returns the transitive subclasses of cls, cls included.
+
+        Parameters:
+            ---cls = the class IRI
+            ---extra = additional (sub, sup) pairs, e.g. the subclasses a
+            building declares in its own graph
+        """
+        if not extra:
+            return self.descendants.get(cls, frozenset([cls]))
+        children = dict((sup, set(subs)) for sup, subs in self.children.items())
+        for sub, sup in extra:
+            children.setdefault(sup, set()).add(sub)
+        return self.walk(cls, children)
+
+    def rollup(self, counts, extra=()):
+        """Rolls instance counts up the hierarchy.
+
+        Parameters:
+            ---counts = dict from class IRI to the number of instances typed
+            with exactly that class
+            ---extra = additional (sub, sup) pairs, see subclasses()
+
+        Returns:
+            ---dict from class IRI to the number of instances of the class
+            and of its subclasses. An instance typed with two classes of
+            the same branch is counted once for each of them.
+        """
+        parents = self.parents
+        if extra:
+            parents = dict((sub, set(sups)) for sub, sups in self.parents.items())
+            for sub, sup in extra:
+                parents.setdefault(sub, set()).add(sup)
+        rolled = dict()
+        for cls, count in counts.items():
+            for sup in self.walk(cls, parents):
+                rolled[sup] = rolled.get(sup, 0) + count
+        return rolled
+
+#-------------------------------------------------------------------------
+def class_hierarchy():
+    "Returns the ClassHierarchy of the shared schema store"
+    global _class_hierarchy
+    if _class_hierarchy is None:
+        _class_hierarchy = ClassHierarchy(schema_graphs())
+    return _class_hierarchy
+
+#-------------------------------------------------------------------------
+def index_path(dbname):
+    "Returns the path of a building's sqlite index"
+    return os.path.join(INDEX_DB_FOLDER, dbname + '.db')
+
+#-------------------------------------------------------------------------
+def open_index(dbname):
+    """Opens the sqlite index of a building.
+
+    Returns:
+        ---an sqlite connection, or None when the building has no index or
+        the index was written by an older version and must not be used
+    """
+    path = index_path(dbname)
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute("select value from meta where key = 'format'").fetchone()
+    except sqlite3.Error:
+        row = None
+    if row is None or row[0] != INDEX_FORMAT:
+        conn.close()
+        return None
+    return conn
+
+#-------------------------------------------------------------------------
+def dedupe_index(conn):
+    """Drops the rows repeated in a building index by a statement that
+    appeared in several ingest batches, and adds the unique indexes that
+    keep them out from then on"""
+    for table, columns in (('triples', 's, p, o'), ('types', 'class, instance'), ('subclasses', 'sub, sup')):
+        conn.execute('delete from %s where rowid not in (select min(rowid) from %s group by %s)' %
+            (table, table, columns))
+    conn.execute('create unique index if not exists triples_spo on triples (s, p, o)')
+    conn.execute('create unique index if not exists types_instance on types (class, instance)')
+    conn.execute('create unique index if not exists subclasses_pair on subclasses (sub, sup)')
+
+#-------------------------------------------------------------------------
+def remove_index(dbname):
+    "Removes the sqlite index of a building, if it has one"
+    path = index_path(dbname)
+    if os.path.exists(path):
+        os.remove(path)
+
+#-------------------------------------------------------------------------
+class BuildingIndexWriter(object):
+    """Builds the sqlite index of a building from the triples written at
+    ingest. The index is written to a temporary file and only moved into
+    place by close(), so a failed ingest never leaves a partial index."""
+
+    TERM_CACHE_SIZE = 100000
+
+    def __init__(self, dbname):
+        self.path = index_path(dbname)
+        self.tmppath = '%s.%d.tmp' % (self.path, os.getpid())
+        if not os.path.exists(INDEX_DB_FOLDER):
+            os.makedirs(INDEX_DB_FOLDER)
+        if os.path.exists(self.tmppath):
+            os.remove(self.tmppath)
+        self.conn = sqlite3.connect(self.tmppath)
+        with app.open_resource('index_schema.sql', mode='r') as f:
+            self.conn.executescript(f.read())
+
+        #recently seen term ids, cleared when it grows past TERM_CACHE_SIZE
+        self.termids = dict()
+
+    def term_id(self, term, bnode=False):
+        """Returns the id of a term's lexical form, adding the term and its
+        trigrams to the index the first time it is seen. Blank node ids
+        get no trigrams, searches never match them.
+
+        Parameters:
+            ---term = the lexical form of the term
+            ---bnode = True if the term is a blank node
+        """
+        key = (term, bnode)
+        termid = self.termids.get(key)
+        if termid is not None:
+            return termid
+        row = self.conn.execute('select id from terms where term = ? and bnode = ?', key).fetchone()
+        if row is not None:
+            termid = row[0]
+        else:
+            termid = self.conn.execute('insert into terms (term, bnode) values (?, ?)', key).lastrowid
+            if not bnode:
+                self.conn.executemany('insert into grams (gram, term) values (?, ?)',
+                    [(gram, termid) for gram in trigrams(term.lower())])
+        if len(self.termids) >= self.TERM_CACHE_SIZE:
+            self.termids.clear()
+        self.termids[key] = termid
+        return termid
+
+    def add(self, triples):
+        "Indexes an iterable of (s, p, o) triples"
+        types = list()
+        subclasses = list()
+        rows = list()
+        for s, p, o in triples:
+            if p == rdflib.RDF.type:
+                types.append((text_type(o), text_type(s)))
+            elif p == rdflib.RDFS.subClassOf:
+                subclasses.append((text_type(s), text_type(o)))
+            rows.append(tuple(self.term_id(text_type(term), isinstance(term, rdflib.BNode))
+                for term in (s, p, o)))
+        #repeats are ignored once close() or dedupe_index() added the unique indexes
+        self.conn.executemany('insert or ignore into types (class, instance) values (?, ?)', types)
+        self.conn.executemany('insert or ignore into subclasses (sub, sup) values (?, ?)', subclasses)
+        self.conn.executemany('insert or ignore into triples (s, p, o) values (?, ?, ?)', rows)
+
+    def close(self, prefixes=()):
+        """Finishes the index and moves it into place
+
+        Parameters:
+            ---prefixes = the (prefix, uri) pairs of the document @context
+        """
+        self.conn.execute("insert into meta (key, value) values ('prefixes', ?)",
+            (json.dumps(list(prefixes)),))
+        #a statement repeated in several batches was inserted once per batch
+        dedupe_index(self.conn)
+        self.conn.execute('create index types_class on types (class)')
+        self.conn.execute('create index grams_gram on grams (gram)')
+        self.conn.execute('create index triples_p on triples (p)')
+        self.conn.execute('create index triples_o on triples (o)')
+        with span('stats'):
+            self.conn.execute("insert into meta (key, value) values ('stats', ?)",
+                (json.dumps(compute_stats(self.conn)),))
+        self.conn.execute("insert into meta (key, value) values ('format', ?)", (INDEX_FORMAT,))
+        self.conn.commit()
+        self.conn.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.tmppath, self.path)
+
+    def abort(self):
+        "Discards the index being written"
+        self.conn.close()
+        os.remove(self.tmppath)
+
+#-------------------------------------------------------------------------
+class BuildingIndexUpdater(BuildingIndexWriter):
+    """Applies the triples added and removed by an incremental update to
+    a building's existing index, in place and in a single sqlite
+    transaction. Terms no longer used by any triple are left in the terms
+    table, they match searches but join no triples.
+
+    The building's statistics are kept up to date from the same changes,
+    only subjects the update touches are looked up again."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.termids = dict()
+        self.stats = read_stats(conn)
+
+    def count(self, table, key, delta):
+        "Adds delta to one counter of the statistics, dropping it at zero"
+        counts = self.stats[table]
+        counts[key] = counts.get(key, 0) + delta
+        if counts[key] <= 0:
+            del counts[key]
+
+    def count_subject(self, subject, delta):
+        "Counts a subject that appeared in or disappeared from the graph"
+        self.stats['subjects'] += delta
+        namespace = namespace_of(subject)
+        if namespace:
+            self.count('namespaces', namespace, delta)
+
+    def has_triples(self, subject, bnode=False):
+        "Returns True if the index holds triples about subject"
+        termid = self.lookup(subject, bnode)
+        return termid is not None and self.conn.execute(
+            'select 1 from triples where s = ? limit 1', (termid,)).fetchone() is not None
+
+    def add(self, triples):
+        "Indexes an iterable of (s, p, o) triples that are not in the index yet"
+        triples = list(triples)
+        for subject, bnode in set((text_type(s), isinstance(s, rdflib.BNode)) for s, p, o in triples):
+            if not self.has_triples(subject, bnode):
+                self.count_subject(subject, 1)
+        for s, p, o in triples:
+            self.stats['triples'] += 1
+            self.count('predicates', text_type(p), 1)
+            if p == rdflib.RDF.type:
+                self.count('classes', text_type(o), 1)
+        super(BuildingIndexUpdater, self).add(triples)
+
+    def lookup(self, term, bnode=False):
+        "Returns the id of a term's lexical form, or None if it is not indexed"
+        termid = self.termids.get((term, bnode))
+        if termid is not None:
+            return termid
+        row = self.conn.execute('select id from terms where term = ? and bnode = ?',
+            (term, bnode)).fetchone()
+        return row[0] if row is not None else None
+
+    def remove(self, triples):
+        "Removes an iterable of (s, p, o) triples from the index"
+        subjects = set()
+        for s, p, o in triples:
+            ids = [self.lookup(text_type(term), isinstance(term, rdflib.BNode)) for term in (s, p, o)]
+            if None in ids:
+                continue
+            if not self.conn.execute('delete from triples where s = ? and p = ? and o = ?', ids).rowcount:
+                continue
+            subjects.add((text_type(s), isinstance(s, rdflib.BNode)))
+            self.stats['triples'] -= 1
+            self.count('predicates', text_type(p), -1)
+            if p == rdflib.RDF.type:
+                if self.conn.execute('delete from types where class = ? and instance = ?',
+                        (text_type(o), text_type(s))).rowcount:
+                    self.count('classes', text_type(o), -1)
+            elif p == rdflib.RDFS.subClassOf:
+                self.conn.execute('delete from subclasses where sub = ? and sup = ?',
+                    (text_type(s), text_type(o)))
+        for subject, bnode in subjects:
+            if not self.has_triples(subject, bnode):
+                self.count_subject(subject, -1)
+
+    def close(self, prefixes=()):
+        """Commits the changes to the index
+
+        Parameters:
+            ---prefixes = the (prefix, uri) pairs of the new document @context
+        """
+        self.conn.execute("update meta set value = ? where key = 'prefixes'",
+            (json.dumps(list(prefixes)),))
+        self.conn.execute("update meta set value = ? where key = 'stats'",
+            (json.dumps(self.stats),))
+        self.conn.commit()
+        self.conn.close()
+
+    def abort(self):
+        "Leaves the index as it was before the update"
+        self.conn.rollback()
+        self.conn.close()
+
+#-------------------------------------------------------------------------
+def namespace_of(iri):
+    """Returns the namespace of an IRI, everything up to its last # or /,
+    or None for terms without one such as blank node ids"""
+    end = max(iri.rfind('#'), iri.rfind('/'))
+    return iri[:end + 1] if end > 0 else None
+
+#-------------------------------------------------------------------------
+def compute_stats(conn):
+    """Computes the statistics of a building from its index.
+
+    Returns:
+        ---dict with the number of distinct triples and subjects, the
+        number of triples of every predicate ('predicates'), of instances
+        typed with every class ('classes', not rolled up) and of subjects
+        in every namespace ('namespaces')
+    """
+    predicates = dict(conn.execute('select tp.term, count(*) from \
+        (select distinct s, p, o from triples) t join terms tp on tp.id = t.p group by tp.term'))
+    classes = dict(conn.execute('select class, count(distinct instance) from types group by class'))
+
+    subjects = 0
+    namespaces = dict()
+    for (subject,) in conn.execute('select term from terms where id in (select s from triples)'):
+        subjects += 1
+        namespace = namespace_of(subject)
+        if namespace:
+            namespaces[namespace] = namespaces.get(namespace, 0) + 1
+
+    return {'triples': sum(predicates.values()),
+            'subjects': subjects,
+            'predicates': predicates,
+            'classes': classes,
+            'namespaces': namespaces}
+
+#-------------------------------------------------------------------------
+def read_stats(conn):
+    """Returns the statistics recorded in a building index, computing and
+    recording them first for an index written before they were kept"""
+    row = conn.execute("select value from meta where key = 'stats'").fetchone()
+    if row is not None:
+        return json.loads(row[0])
+    stats = compute_stats(conn)
+    conn.execute("insert into meta (key, value) values ('stats', ?)", (json.dumps(stats),))
+    conn.commit()
+    return stats
+
+#-------------------------------------------------------------------------
+def trigrams(text):
+    "Returns the set of three character substrings of text"
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+#-------------------------------------------------------------------------
+def match_terms(conn, searchterm):
+    """Finds the terms of a building index whose lexical form contains
+    searchterm, ignoring case, and stores their ids in the temporary
+    table hits. Terms are narrowed down through their trigrams and then
+    checked, so only candidate terms are ever compared. Blank node ids
+    never match, as in the SPARQL and scan searches."""
+    needle = searchterm.lower()
+    conn.execute('create temp table if not exists hits (id integer primary key)')
+    conn.execute('delete from hits')
+
+    grams = list(trigrams(needle))[:200]
+    if grams:
+        cur = conn.execute('select id, term from terms where not bnode and id in \
+            (select term from grams where gram in (%s) group by term having count(*) = ?)' %
+            ', '.join('?' * len(grams)), grams + [len(grams)])
+    else:
+        #too short for trigrams, every distinct term is checked instead
+        cur = conn.execute('select id, term from terms where not bnode')
+
+    conn.executemany('insert into hits (id) values (?)',
+        ((termid,) for termid, term in cur.fetchall() if needle in term.lower()))
+
+#-------------------------------------------------------------------------
+def indexed_search_rows(conn, searchterm, position, compactor):
+    """Answers a custom search from a building index in a single pass.
+
+    Parameters:
+        ---conn = the building index, see open_index()
+        ---searchterm = the text searched for, as a case insensitive substring
+        ---position = subject, property, object or all
+        ---compactor = the PrefixCompactor of the building
+
+    Returns:
+        ---a generator of (position, row) pairs, position being the one
+        the term matched at. In all mode a triple matching at several
+        positions is yielded once for each of them.
+    """
+    match_terms(conn, searchterm)
+    if position == 'all':
+        where = 't.s in hits or t.p in hits or t.o in hits'
+    else:
+        where = 't.%s in hits' % POSITION_VARS[position]
+    cur = conn.execute('select ts.term, tp.term, tobj.term, \
+        t.s in hits, t.p in hits, t.o in hits from triples t \
+        join terms ts on ts.id = t.s join terms tp on tp.id = t.p join terms tobj on tobj.id = t.o \
+        where %s order by t.rowid' % where)
+    for s, p, o, smatch, pmatch, omatch in cur:
+        row = triple_row(s, p, o, compactor)
+        if smatch and position in ('subject', 'all'):
+            yield 'subject', row
+        if pmatch and position in ('property', 'all'):
+            yield 'property', row
+        if omatch and position in ('object', 'all'):
+            yield 'object', row
+
+#-------------------------------------------------------------------------
+def indexed_class_instances(conn, classiri):
+    """Answers a class search from the class hierarchy and the building's
+    type index instead of evaluating rdfs:subClassOf* with SPARQL.
+
+    Parameters:
+        ---conn = the building index, see open_index()
+        ---classiri = the full IRI of the Brick class
+
+    Returns:
+        ---a generator over the distinct instances of the class and of
+        its subclasses
+    """
+    hierarchy = class_hierarchy()
+    extra = conn.execute('select sub, sup from subclasses').fetchall()
+    classes = list(hierarchy.subclasses(classiri, extra))
+
+    seen = set()
+    #stays below sqlite's limit on the number of query parameters
+    for i in range(0, len(classes), 500):
+        chunk = classes[i:i + 500]
+        cur = conn.execute('select instance from types where class in (%s)' %
+            ', '.join('?' * len(chunk)), chunk)
+        for row in cur:
+            if row[0] not in seen:
+                seen.add(row[0])
+                yield row[0]
+    for cls in classes:
+        for instance in hierarchy.schema_types.get(cls, ()):
+            if instance not in seen:
+                seen.add(instance)
+                yield instance
+
+#-------------------------------------------------------------------------
+def snapshot_path(dbname):
+    "Returns the path of a building's snapshot"
+    return os.path.join(SNAPSHOT_DB_FOLDER, dbname + '.snap')
+
+#-------------------------------------------------------------------------
+def remove_snapshot(dbname):
+    "Removes the snapshot of a building, if it has one"
+    path = snapshot_path(dbname)
+    if os.path.exists(path):
+        os.remove(path)
+
+#-------------------------------------------------------------------------
+def encode_term(term):
+    """Returns the bytes a term is stored as in a snapshot: U, B or L
+    followed by the IRI, the blank node id or the literal's lexical
+    form, language and datatype separated by NUL bytes. Falsy literals
+    keep their lexical form:
+
+    >>> all(decode_term(encode_term(rdflib.Literal(v))) == rdflib.Literal(v)
+    ...     for v in (0, 0.0, False, u''))
+    True
+    """
+    if isinstance(term, rdflib.Literal):
+        return b'L' + b'\x00'.join(part.encode('utf-8')
+            for part in (text_type(term), term.language or u'', text_type(term.datatype or u'')))
+    if isinstance(term, rdflib.BNode):
+        return b'B' + text_type(term).encode('utf-8')
+    return b'U' + text_type(term).encode('utf-8')
+
+#-------------------------------------------------------------------------
+def decode_term(data):
+    "Returns the term encoded by encode_term()"
+    kind, body = data[:1], data[1:]
+    if kind == b'U':
+        return rdflib.URIRef(body.decode('utf-8'))
+    if kind == b'B':
+        return rdflib.BNode(body.decode('utf-8'))
+    lexical, language, datatype = body.rsplit(b'\x00', 2)
+    return rdflib.Literal(lexical.decode('utf-8'), lang=language.decode('utf-8') or None,
+        datatype=rdflib.URIRef(datatype.decode('utf-8')) if datatype else None)
+
+#-------------------------------------------------------------------------
+class SnapshotWriter(object):
+    """Builds the snapshot of a building from the triples written at
+    ingest: a table of the distinct terms sorted by their encoded bytes
+    and the triples as rows of term ids, sorted in SPO, POS and OSP order.
+
+    Terms and triples are spilled to a temporary sqlite db as they come,
+    and sqlite sorts them on disk, so memory use does not grow with the
+    size of the building. Like the index, the snapshot is written to a
+    temporary file and only moved into place by close()."""
+
+    TERM_CACHE_SIZE = 100000
+    CHUNK_SIZE = 65536
+
+    def __init__(self, dbname):
+        self.path = snapshot_path(dbname)
+        if not os.path.exists(SNAPSHOT_DB_FOLDER):
+            os.makedirs(SNAPSHOT_DB_FOLDER)
+        self.buildpath = '%s.%d.build' % (self.path, os.getpid())
+        if os.path.exists(self.buildpath):
+            os.remove(self.buildpath)
+        self.conn = sqlite3.connect(self.buildpath)
+        self.conn.execute('pragma journal_mode = off')
+        self.conn.execute('pragma synchronous = off')
+        self.conn.execute('create table terms (id integer primary key, term blob not null unique)')
+        self.conn.execute('create table rows (s integer not null, p integer not null, o integer not null)')
+
+        #recently seen term ids, cleared when it grows past TERM_CACHE_SIZE
+        self.termids = dict()
+
+    def term_id(self, encoded):
+        "Returns the id of an encoded term, adding it the first time it is seen"
+        termid = self.termids.get(encoded)
+        if termid is not None:
+            return termid
+        row = self.conn.execute('select id from terms where term = ?', (sqlite3.Binary(encoded),)).fetchone()
+        if row is not None:
+            termid = row[0]
+        else:
+            termid = self.conn.execute('insert into terms (term) values (?)',
+                (sqlite3.Binary(encoded),)).lastrowid
+        if len(self.termids) >= self.TERM_CACHE_SIZE:
+            self.termids.clear()
+        self.termids[encoded] = termid
+        return termid
+
+    def add(self, triples):
+        "Adds an iterable of (s, p, o) triples"
+        triples = iter(triples)
+        while True:
+            rows = [tuple(self.term_id(encode_term(term)) for term in triple)
+                for triple in itertools.islice(triples, self.CHUNK_SIZE)]
+            if not rows:
+                break
+            self.conn.executemany('insert into rows (s, p, o) values (?, ?, ?)', rows)
+
+    def close(self):
+        """Writes the snapshot and moves it into place
+
+        Returns:
+            ---the number of distinct triples written
+        """
+        conn = self.conn
+        self.termids = None
+        #ids follow the byte order of the terms, so terms can be looked up by bisection
+        conn.execute('create table ranks (id integer primary key, rank integer not null)')
+        nterms = conn.execute('select count(*) from terms').fetchone()[0]
+
+        tmppath = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmppath, 'wb') as f:
+                f.write(b'\x00' * SNAPSHOT_HEADER.size)
+                offsets = f.tell()
+                position = 0
+                ranks = list()
+                cur = conn.execute('select id, length(term) from terms order by term')
+                for rank, (termid, length) in enumerate(cur):
+                    f.write(struct.pack('<Q', position))
+                    position += length
+                    ranks.append((termid, rank))
+                    if len(ranks) == self.CHUNK_SIZE:
+                        conn.executemany('insert into ranks (id, rank) values (?, ?)', ranks)
+                        ranks = list()
+                conn.executemany('insert into ranks (id, rank) values (?, ?)', ranks)
+                f.write(struct.pack('<Q', position))
+                data = f.tell()
+                for (encoded,) in conn.execute('select term from terms order by term'):
+                    f.write(bytes(encoded))
+
+                starts = list()
+                ntriples = 0
+                for order in SNAPSHOT_ORDERS:
+                    starts.append(f.tell())
+                    columns = ', '.join('r%d.rank' % i for i in order)
+                    cur = conn.execute('select distinct %s from rows \
+                        join ranks r0 on r0.id = rows.s join ranks r1 on r1.id = rows.p \
+                        join ranks r2 on r2.id = rows.o order by 1, 2, 3' % columns)
+                    ntriples = 0
+                    while True:
+                        chunk = cur.fetchmany(self.CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        ordered = array('I', itertools.chain.from_iterable(chunk))
+                        if sys.byteorder == 'big':
+                            ordered.byteswap()
+                        f.write(ordered.tostring())
+                        ntriples += len(chunk)
+
+                f.seek(0)
+                f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, nterms, ntriples,
+                    offsets, data, starts[0], starts[1], starts[2]))
+        except Exception:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+        finally:
+            self.abort()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmppath, self.path)
+        return ntriples
+
+    def abort(self):
+        "Discards the snapshot being built"
+        self.termids = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if os.path.exists(self.buildpath):
+            os.remove(self.buildpath)
+
+#-------------------------------------------------------------------------
+class SnapshotStore(rdflib.store.Store):
+    """Read-only rdflib store over a building snapshot. The file is memory
+    mapped, so opening it costs no parsing and its pages are shared with
+    every other process reading the same building. Triple patterns are
+    answered by bisecting the SPO, POS or OSP array, whichever has the
+    bound terms first, and terms are decoded only when they are returned."""
+
+    TERM_CACHE_SIZE = 100000
+
+    def __init__(self, configuration=None, identifier=None):
+        self.mm = None
+        self.terms = dict()
+        super(SnapshotStore, self).__init__(configuration, identifier)
+
+    def open(self, configuration, create=False):
+        if not os.path.exists(configuration):
+            return rdflib.store.NO_STORE
+        with open(configuration, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = SNAPSHOT_HEADER.unpack_from(self.mm, 0)
+        if header[0] != SNAPSHOT_MAGIC:
+            self.close()
+            return rdflib.store.CORRUPTED_STORE
+        self.nterms, self.ntriples, self.offsets, self.data = header[1:5]
+        self.arrays = header[5:]
+        return rdflib.store.VALID_STORE
+
+    def close(self, commit_pending_transaction=False):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def term_bytes(self, termid):
+        start, end = struct.unpack_from('<2Q', self.mm, self.offsets + 8 * termid)
+        return self.mm[self.data + start:self.data + end]
+
+    def term(self, termid):
+        "Returns the term of an id, decoding it on first use"
+        term = self.terms.get(termid)
+        if term is None:
+            if len(self.terms) >= self.TERM_CACHE_SIZE:
+                self.terms.clear()
+            term = self.terms[termid] = decode_term(self.term_bytes(termid))
+        return term
+
+    def term_id(self, term):
+        "Returns the id of a term, or None if the snapshot does not hold it"
+        encoded = encode_term(term)
+        lo, hi = 0, self.nterms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term_bytes(mid) < encoded:
+                lo = mid + 1
             else:
-                tmp['p'] = ''
-            
-            if row['o']:
-                tmp['o'] = shortenURI(row['o'])
+                hi = mid
+        if lo < self.nterms and self.term_bytes(lo) == encoded:
+            return lo
+        return None
+
+    def row(self, order, i):
+        return SNAPSHOT_ROW.unpack_from(self.mm, self.arrays[order] + SNAPSHOT_ROW.size * i)
+
+    def bisect(self, order, prefix, right):
+        """Returns the first row of an array whose leading ids are greater
+        than or equal to prefix, or greater than it when right is set"""
+        n = len(prefix)
+        lo, hi = 0, self.ntriples
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = self.row(order, mid)[:n]
+            if key < prefix or (right and key == prefix):
+                lo = mid + 1
             else:
-                tmp['o'] = ''
-            d['result']['propertywise'].append(tmp)
+                hi = mid
+        return lo
 
-        for row in queryResult3:
-            tmp = dict()
-            if row['s']:
-                tmp['s'] = shortenURI(row['s'])
+    def triples(self, triple_pattern, context=None):
+        ids = list()
+        for term in triple_pattern:
+            termid = None
+            if term is not None:
+                termid = self.term_id(term)
+                if termid is None:
+                    return
+            ids.append(termid)
+        s, p, o = ids
+
+        if s is not None:
+            order = 2 if p is None and o is not None else 0
+        elif p is not None:
+            order = 1
+        elif o is not None:
+            order = 2
+        else:
+            order = 0
+        positions = SNAPSHOT_ORDERS[order]
+        prefix = list()
+        for position in positions:
+            if ids[position] is None:
+                break
+            prefix.append(ids[position])
+        prefix = tuple(prefix)
+
+        for i in range(self.bisect(order, prefix, False), self.bisect(order, prefix, True)):
+            row = self.row(order, i)
+            triple = [None, None, None]
+            for position, termid in zip(positions, row):
+                triple[position] = self.term(termid)
+            yield tuple(triple), iter(())
+
+    def __len__(self, context=None):
+        return self.ntriples
+
+    def add(self, triple, context, quoted=False):
+        raise rdflib.graph.ModificationException()
+
+    def addN(self, quads):
+        raise rdflib.graph.ModificationException()
+
+    def remove(self, triple, context=None):
+        raise rdflib.graph.ModificationException()
+
+#open snapshots by building with their file_identity(), left to the
+#garbage collector once dropped
+_snapshots = dict()
+_snapshots_lock = threading.Lock()
+
+#-------------------------------------------------------------------------
+def open_snapshot(dbname):
+    """Returns a read-only graph over the snapshot of a building, or None
+    if the building has no snapshot. A snapshot that was rewritten or
+    removed since it was mapped, possibly by another process, is mapped
+    again."""
+    path = snapshot_path(dbname)
+    identity = file_identity(path)
+    with _snapshots_lock:
+        entry = _snapshots.get(dbname)
+        if entry is not None and entry[0] == identity:
+            return entry[1]
+        _snapshots.pop(dbname, None)
+        if identity is None:
+            return None
+        store = SnapshotStore()
+        with span('store_open'):
+            rt = store.open(path)
+        if rt != rdflib.store.VALID_STORE:
+            return None
+        graph = rdflib.Graph(store=store, identifier=building_graph_uri(dbname))
+        _snapshots[dbname] = (identity, graph)
+        return graph
+
+#-------------------------------------------------------------------------
+@contextmanager
+def building_graph(dbname):
+    """Context manager over the graph of a building for reading: its
+    snapshot when it has one, the named graph of its store otherwise.
+
+    Returns:
+        ---the graph, or None if the building has no store
+    """
+    graph = open_snapshot(dbname)
+    if graph is not None:
+        yield graph
+        return
+    with building_dataset(dbname) as ds:
+        yield ds.get_context(building_graph_uri(dbname)) if ds is not None else None
+
+#-------------------------------------------------------------------------
+class JsonStream(object):
+    """Reads a json text file incrementally and decodes one value at a
+    time, so that only the value being decoded has to be held in memory"""
+
+    def __init__(self, f, chunksize=65536):
+        self.f = f
+        self.chunksize = chunksize
+        self.decoder = json.JSONDecoder()
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        "Appends the next chunk of the file to the buffer"
+        chunk = self.f.read(self.chunksize)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next non whitespace character without consuming it,
+        or an empty string at the end of the file"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in u' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return u''
+
+    def take(self, ch):
+        "Consumes the next non whitespace character, which must be ch"
+        if self.peek() != ch:
+            raise ValueError('Expected %r in json document' % ch)
+        self.pos += 1
+
+    def value(self):
+        "Decodes and consumes the next json value"
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                #a number at the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return obj
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def items(self):
+        "Yields the values of the json array starting at the current position"
+        self.take(u'[')
+        if self.peek() == u']':
+            self.take(u']')
+            return
+        while True:
+            yield self.value()
+            if self.peek() == u',':
+                self.take(u',')
             else:
-                tmp['s'] = ''
-            
-            if row['p']:
-                tmp['p'] = shortenURI(row['p'])
+                self.take(u']')
+                return
+
+#-------------------------------------------------------------------------
+def iter_jsonld_nodes(jsonldfilepath, header):
+    """Yields the top level nodes of a jsonld document one at a time.
+
+    Parameters:
+        ---jsonldfilepath = path to the jsonld file
+        ---header = a dict that receives every top level member other
+        than @graph, @context included, as soon as it has been read
+
+    Returns:
+        ---a generator over the node objects of @graph, or over the
+        elements of a top level array. A top level object's own members
+        are yielded last as one more node.
+    """
+    with io.open(jsonldfilepath, encoding='utf-8-sig') as f:
+        stream = JsonStream(f)
+
+        if stream.peek() == u'[':
+            for node in stream.items():
+                yield node
+            return
+
+        pending = list()
+        stream.take(u'{')
+        while stream.peek() != u'}':
+            key = stream.value()
+            stream.take(u':')
+            if key == u'@graph' and stream.peek() == u'[':
+                if u'@context' in header:
+                    for node in stream.items():
+                        yield node
+                else:
+                    #the context may still follow, so the nodes are kept
+                    pending = list(stream.items())
             else:
-                tmp['p'] = ''
-            
-            if row['o']:
-                tmp['o'] = shortenURI(row['o'])
+                header[key] = stream.value()
+            if stream.peek() == u',':
+                stream.take(u',')
+        stream.take(u'}')
+
+        for node in pending:
+            yield node
+
+        rest = dict((k, v) for k, v in header.items() if k != u'@context')
+        if rest:
+            yield rest
+
+#-------------------------------------------------------------------------
+def pretty_path(jsonldfilepath):
+    "Returns the path of the pretty printed copy of an uploaded file"
+    return jsonldfilepath + '.pretty.json'
+
+#-------------------------------------------------------------------------
+def write_pretty_json(jsonldfilepath, out):
+    """Writes a jsonld document to out pretty printed with an indent of
+    four, like json.dumps(d, indent=4), keeping the order of its members.
+    Top level arrays, such as @graph, are copied one element at a time so
+    the document is never held in memory as a whole.
+
+    Parameters:
+        ---jsonldfilepath = path to the jsonld file
+        ---out = a file opened for writing bytes
+    """
+    def emit(text):
+        out.write(text.encode('utf-8'))
+
+    def dump(value, depth):
+        return json.dumps(value, indent=4, separators=(',', ': ')).replace('\n', '\n' + '    ' * depth)
+
+    with io.open(jsonldfilepath, encoding='utf-8-sig') as f:
+        stream = JsonStream(f)
+
+        def copy_array(depth):
+            emit('[')
+            count = 0
+            for item in stream.items():
+                emit((',\n' if count else '\n') + '    ' * (depth + 1) + dump(item, depth + 1))
+                count += 1
+            emit('\n' + '    ' * depth + ']' if count else ']')
+
+        if stream.peek() == u'[':
+            copy_array(0)
+            return
+
+        stream.take(u'{')
+        emit('{')
+        count = 0
+        while stream.peek() != u'}':
+            key = stream.value()
+            stream.take(u':')
+            emit((',\n' if count else '\n') + '    ' + json.dumps(key) + ': ')
+            if stream.peek() == u'[':
+                copy_array(1)
             else:
-                tmp['o'] = ''
-            d['result']['objectwise'].append(tmp)
+                emit(dump(stream.value(), 1))
+            count += 1
+            if stream.peek() == u',':
+                stream.take(u',')
+        stream.take(u'}')
+        emit('\n}' if count else '}')
 
-        return jsonify(d)
+#-------------------------------------------------------------------------
+def save_pretty_json(jsonldfilepath):
+    """Stores the pretty printed form of an uploaded file next to it,
+    together with a gzip compressed copy when VIEWER_GZIP is set, so the
+    viewer never has to parse and re-serialize the upload"""
+    path = pretty_path(jsonldfilepath)
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmppath, 'wb') as out:
+        write_pretty_json(jsonldfilepath, out)
+
+    if app.config['VIEWER_GZIP']:
+        gztmppath = tmppath + '.gz'
+        with open(tmppath, 'rb') as src:
+            with open(gztmppath, 'wb') as raw:
+                #a fixed mtime keeps the compressed bytes, and so the ETag, stable
+                gz = gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0)
+                shutil.copyfileobj(src, gz, 65536)
+                gz.close()
+        if os.path.exists(path + '.gz'):
+            os.remove(path + '.gz')
+        os.rename(gztmppath, path + '.gz')
+    elif os.path.exists(path + '.gz'):
+        os.remove(path + '.gz')
+
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmppath, path)
+
+#-------------------------------------------------------------------------
+def remove_pretty_json(jsonldfilepath):
+    "Removes the pretty printed copies of an uploaded file"
+    path = pretty_path(jsonldfilepath)
+    for p in (path, path + '.gz'):
+        if os.path.exists(p):
+            os.remove(p)
+
+#-------------------------------------------------------------------------
+def jsonld_batches(jsonldfilepath, header, batchsize, basepath=None):
+    """Parses a jsonld file node by node (see iter_jsonld_nodes()).
+
+    Parameters:
+        ---jsonldfilepath = path to the jsonld file
+        ---header = a dict that receives the top level members of the
+        document other than @graph, its @context included
+        ---batchsize = number of triples after which a batch is yielded
+        ---basepath = optional path relative IRIs resolve against instead
+        of jsonldfilepath, e.g. the upload a temporary copy will replace
+
+    Returns:
+        ---a generator of rdflib.ConjunctiveGraph batches of the expanded
+        triples, each holding about batchsize triples
+    """
+    #relative IRIs resolve against the file, as in Graph.parse()
+    base = urljoin('file:', pathname2url(os.path.abspath(basepath or jsonldfilepath)))
+    parser = JsonLdParser()
+    context = None
+    nodes = list()
+    batch = rdflib.ConjunctiveGraph()
+
+    for node in iter_jsonld_nodes(jsonldfilepath, header):
+        nodes.append(node)
+        if len(nodes) < 256:
+            continue
+        if context is None:
+            context = JsonLdContext(header.get(u'@context'), base=base)
+        with span('jsonld_parse'):
+            parser.parse(nodes, context, batch)
+        nodes = list()
+        if len(batch) >= batchsize:
+            yield batch
+            batch = rdflib.ConjunctiveGraph()
+
+    if nodes:
+        if context is None:
+            context = JsonLdContext(header.get(u'@context'), base=base)
+        with span('jsonld_parse'):
+            parser.parse(nodes, context, batch)
+    yield batch
+
+#-------------------------------------------------------------------------
+def flush_batch(batch, graph, writers):
+    """Writes the triples parsed into a temporary batch graph to the
+    store with one addN call and adds them to the building's index and
+    snapshot.
+
+    Parameters:
+        ---writers = the BuildingIndexWriter and SnapshotWriter of the building
+
+    Returns:
+        ---the number of triples in the batch
+    """
+    with span('triple_copy'):
+        graph.addN((s, p, o, graph) for s, p, o in batch.triples((None, None, None)))
+        for writer in writers:
+            writer.add(batch.triples((None, None, None)))
+    return len(batch)
+
+#-------------------------------------------------------------------------
+def save_in_sleepycat(dbname, jsonldfilepath, progress=None):
+    """Parses an uploaded jsonld file into the building's own Sleepycat
+    store, or into its named graph of the shared store in shared mode.
+    The Brick schema is not copied in, it is served from the shared
+    schema store (see get_schema_store()).
+
+    The document is streamed node by node (see iter_jsonld_nodes()) and
+    the expanded triples are written in batches of INGEST_BATCH_SIZE, so
+    memory use does not grow with the size of the upload.
+
+    Parameters:
+        ---dbname = the folder name of the building's store
+        ---jsonldfilepath = path to the uploaded jsonld file
+        ---progress = optional callable(phase, triples) told about each
+        phase and about the number of triples written so far
+
+    Returns:
+        ---the number of triples in the building graph
+    """
+    dbpath = store_path(dbname)
+
+    #runs in an ingest worker, which opens its own handle on the store
+    ds = rdflib.Dataset(store='Sleepycat', default_union=True)
+    with span('store_open'):
+        rt = ds.open(dbpath, create=False)
+
+        if rt == rdflib.store.NO_STORE:
+            ds.open(dbpath, create=True)
+
+    uploadedBldg = building_graph_uri(dbname)
+    if shared_storage():
+        #the graph may hold what a failed earlier ingest left behind
+        ds.remove_graph(uploadedBldg)
+    g4 = ds.graph(uploadedBldg)
+
+    #the old index and snapshot no longer match the store once writing starts
+    remove_index(dbname)
+    remove_snapshot(dbname)
+    index = BuildingIndexWriter(dbname)
+    writers = [index]
+    if app.config['WRITE_SNAPSHOTS']:
+        writers.append(SnapshotWriter(dbname))
+
+    header = dict()
+    written = 0
+    started = time.time()
+
+    try:
+        if progress:
+            progress('parsing', 0)
+
+        for batch in jsonld_batches(jsonldfilepath, header, app.config['INGEST_BATCH_SIZE']):
+            written += flush_batch(batch, g4, writers)
+            if progress:
+                progress('writing', written)
+
+        with span('snapshot_write'):
+            for writer in writers[1:]:
+                writer.close()
+        prefixes = context_prefixes(header.get(u'@context'))
+        index.close(prefixes)
+        write_prefixes(dbname, prefixes)
+    except Exception:
+        for writer in writers:
+            writer.abort()
+        remove_snapshot(dbname)
+        ds.close()
+        raise
+
+    elapsed = time.time() - started
+    app.logger.info('Wrote %d triples to %s in %.2fs (%.0f triples/s)',
+        written, dbname, elapsed, written / max(elapsed, 1e-6))
+
+    ts = len(g4)
+
+    ds.close()
+
+    return ts
+
+#-------------------------------------------------------------------------
+def has_bnode(triple):
+    "Returns True if any term of a triple is a blank node"
+    return any(isinstance(term, rdflib.BNode) for term in triple)
+
+#-------------------------------------------------------------------------
+def bnode_components(triples):
+    """Groups triples with blank nodes into the components connected
+    through their blank nodes, e.g. a node and its nested objects.
+
+    Returns:
+        ---a list of lists of triples
+    """
+    parent = dict()
+    def root(node):
+        while parent.get(node, node) != node:
+            node = parent[node]
+        return node
+
+    for triple in triples:
+        bnodes = [root(term) for term in triple if isinstance(term, rdflib.BNode)]
+        for bnode in bnodes:
+            parent[bnode] = bnodes[0]
+
+    components = dict()
+    for triple in triples:
+        first = next(term for term in triple if isinstance(term, rdflib.BNode))
+        components.setdefault(root(first), list()).append(triple)
+    return list(components.values())
+
+#-------------------------------------------------------------------------
+def component_digests(triples):
+    """Returns a dict from the canonical digest of every blank node
+    component to the components having it. Components that only differ
+    in their blank node labels have the same digest."""
+    digests = dict()
+    for component in bnode_components(triples):
+        graph = rdflib.Graph()
+        for triple in component:
+            graph.add(triple)
+        digest = to_isomorphic(graph).graph_digest()
+        digests.setdefault(digest, list()).append(component)
+    return digests
+
+#-------------------------------------------------------------------------
+def graph_delta(stored, updated):
+    """Compares a stored building graph with the parsed new version of
+    the building. Triples without blank nodes are compared directly,
+    looking them up in the other graph. Triples with blank nodes are
+    compared as whole components through their canonical digests, since
+    the parser labels blank nodes anew on every parse.
+
+    Parameters:
+        ---stored = the building's graph in its store
+        ---updated = an in memory graph of the new version
+
+    Returns:
+        ---(added, removed) lists of triples that turn stored into updated
+    """
+    added = list()
+    removed = list()
+    newbnodes = list()
+    for triple in updated.triples((None, None, None)):
+        if has_bnode(triple):
+            newbnodes.append(triple)
+        elif triple not in stored:
+            added.append(triple)
+
+    oldbnodes = list()
+    for triple in stored.triples((None, None, None)):
+        if has_bnode(triple):
+            oldbnodes.append(triple)
+        elif triple not in updated:
+            removed.append(triple)
+
+    olddigests = component_digests(oldbnodes)
+    newdigests = component_digests(newbnodes)
+    for digest, components in newdigests.items():
+        for component in components[len(olddigests.get(digest, ())):]:
+            added.extend(component)
+    for digest, components in olddigests.items():
+        for component in components[len(newdigests.get(digest, ())):]:
+            removed.extend(component)
+    return added, removed
+
+#-------------------------------------------------------------------------
+def update_in_sleepycat(dbname, jsonldfilepath, progress=None, basepath=None):
+    """Brings a building's graph up to date with a new version of its
+    jsonld file by writing only the triples that changed, and applies the
+    same changes to the building index.
+
+    Parameters:
+        ---dbname = the folder name of the building's store
+        ---jsonldfilepath = path to the new version of the jsonld file
+        ---progress = optional callable(phase, triples) told about each phase
+        ---basepath = the path of the upload the new version replaces, the
+        base of its relative IRIs, see jsonld_batches()
+
+    Returns:
+        ---(triples in the building graph, triples added, triples removed)
+    """
+    if progress:
+        progress('parsing', 0)
+    header = dict()
+    updated = rdflib.Graph()
+    for batch in jsonld_batches(jsonldfilepath, header, app.config['INGEST_BATCH_SIZE'], basepath):
+        updated.addN((s, p, o, updated) for s, p, o in batch.triples((None, None, None)))
+    prefixes = context_prefixes(header.get(u'@context'))
+
+    ds = rdflib.Dataset(store='Sleepycat', default_union=True)
+    with span('store_open'):
+        rt = ds.open(store_path(dbname), create=False)
+    if rt == rdflib.store.NO_STORE:
+        raise ValueError('No RDF DB exists for %s' % dbname)
+    try:
+        g4 = ds.get_context(building_graph_uri(dbname))
+
+        if progress:
+            progress('diffing', len(updated))
+        with span('diff'):
+            added, removed = graph_delta(g4, updated)
+
+        if progress:
+            progress('writing', len(added) + len(removed))
+        conn = open_index(dbname)
+        index = BuildingIndexUpdater(conn) if conn is not None else None
+        try:
+            with span('triple_copy'):
+                for triple in removed:
+                    g4.remove(triple)
+                g4.addN((s, p, o, g4) for s, p, o in added)
+                if index is not None:
+                    index.remove(removed)
+                    index.add(added)
+        except Exception:
+            if index is not None:
+                index.abort()
+            raise
+
+        if index is not None:
+            index.close(prefixes)
+        else:
+            #no usable index, it is rebuilt from the updated graph
+            index = BuildingIndexWriter(dbname)
+            try:
+                index.add(g4.triples((None, None, None)))
+            except Exception:
+                index.abort()
+                raise
+            index.close(prefixes)
+
+        write_prefixes(dbname, prefixes)
+
+        #the snapshot is rewritten whole, its arrays are sorted
+        remove_snapshot(dbname)
+        if app.config['WRITE_SNAPSHOTS']:
+            with span('snapshot_write'):
+                snapshot = SnapshotWriter(dbname)
+                try:
+                    snapshot.add(g4.triples((None, None, None)))
+                except Exception:
+                    snapshot.abort()
+                    raise
+                snapshot.close()
+
+        ts = len(g4)
+    finally:
+        ds.close()
+
+    app.logger.info('Updated %s: %d triples added, %d removed', dbname, len(added), len(removed))
+    return ts, len(added), len(removed)
+
+#-------------------------------------------------------------------------
+#ingest worker pool : created on the first upload
+_ingest_pool = None
+_ingest_pool_lock = threading.Lock()
+
+#-------------------------------------------------------------------------
+def get_ingest_pool():
+    """Returns the process pool that runs ingest jobs. rdflib parsing is
+    CPU bound, so jobs run in separate processes rather than threads."""
+    global _ingest_pool
+    with _ingest_pool_lock:
+        if _ingest_pool is None:
+            _ingest_pool = multiprocessing.Pool(processes=app.config['INGEST_WORKERS'])
+        return _ingest_pool
+
+#-------------------------------------------------------------------------
+def update_job(db, jobid, status, phase, triples=None, error=None):
+    """Records the current state of an ingest job in the jobs table"""
+    if triples is None:
+        db.execute('update jobs set status = ?, phase = ?, error = ?, updatedtime = ? \
+            where jobid = ?', (status, phase, error, datetime.now(), jobid))
+    else:
+        db.execute('update jobs set status = ?, phase = ?, triples = ?, error = ?, \
+            updatedtime = ? where jobid = ?', (status, phase, triples, error, datetime.now(), jobid))
+    db.commit()
+
+#-------------------------------------------------------------------------
+def record_ingest(db, filetitle, triples, jsonldfilepath, seconds):
+    """Stores the statistics of a finished ingest in the jsonfiles row,
+    so that listings never have to open the stores"""
+    db.execute('update jsonfiles set triplecount = ?, filesize = ?, ingestseconds = ? \
+        where filetitle = (?)', (triples, os.path.getsize(jsonldfilepath), seconds, filetitle))
+
+#-------------------------------------------------------------------------
+def run_ingest_job(jobid, filetitle, jsonldfilepath):
+    """Runs inside an ingest worker process. Parses the uploaded file into
+    the building's store and keeps the jobs and jsonfiles rows up to date.
+
+    Parameters:
+        ---jobid = the id returned to the client by addfile()
+        ---filetitle = the title the file was uploaded with
+        ---jsonldfilepath = path to the uploaded jsonld file
+
+    Returns:
+        ---a (jobid, filetitle, status, spans) tuple
+    """
+    db = connect_db()
+    start_spans()
+    started = time.time()
+    try:
+        def progress(phase, triples):
+            update_job(db, jobid, 'running', phase, triples)
+
+        dbname = '_'.join(filetitle.split())
+        triples = save_in_sleepycat(dbname=dbname, jsonldfilepath=jsonldfilepath, progress=progress)
+        progress('viewer', triples)
+        save_pretty_json(jsonldfilepath)
+        record_ingest(db, filetitle, triples, jsonldfilepath, time.time() - started)
+        status = 'ready'
+        update_job(db, jobid, 'done', 'done', triples)
+    except Exception:
+        status = 'failed'
+        update_job(db, jobid, 'failed', 'failed', error=traceback.format_exc())
+    finally:
+        #a new version keeps other processes from serving cached results
+        db.execute('update jsonfiles set status = ?, version = version + 1 \
+            where filetitle = (?)', (status, filetitle))
+        db.commit()
+        db.close()
+    return jobid, filetitle, status, finish_spans()
+
+#-------------------------------------------------------------------------
+def run_update_job(jobid, filetitle, jsonldfilepath):
+    """Runs inside an ingest worker process. Applies a new version of a
+    building's file to its store and, once that succeeded, moves the new
+    file in place of the old upload.
+
+    Parameters:
+        ---jobid = the id returned to the client by update()
+        ---filetitle = the title of the building
+        ---jsonldfilepath = path the new version was saved to, next to the
+        old upload
+
+    Returns:
+        ---a (jobid, filetitle, status, spans) tuple
+    """
+    db = connect_db()
+    status = 'ready'
+    start_spans()
+    started = time.time()
+    try:
+        def progress(phase, triples):
+            update_job(db, jobid, 'running', phase, triples)
+
+        dbname = '_'.join(filetitle.split())
+        result = db.execute('select filename from jsonfiles where filetitle = (?)', (filetitle,)).fetchone()
+        uploadpath = os.path.join(os.path.dirname(jsonldfilepath), result[0])
+        #relative IRIs must resolve as they did when the upload was ingested
+        triples, added, removed = update_in_sleepycat(dbname, jsonldfilepath, progress, uploadpath)
+        db.execute('update jobs set added = ?, removed = ? where jobid = ?', (added, removed, jobid))
+
+        progress('viewer', triples)
+        os.rename(jsonldfilepath, uploadpath)
+        save_pretty_json(uploadpath)
+        record_ingest(db, filetitle, triples, uploadpath, time.time() - started)
+        update_job(db, jobid, 'done', 'done', triples)
+    except Exception:
+        #the store may be partly updated once writing started
+        cur = db.execute('select phase from jobs where jobid = ?', (jobid,))
+        if cur.fetchone()[0] in ('writing', 'viewer'):
+            status = 'failed'
+        update_job(db, jobid, 'failed', 'failed', error=traceback.format_exc())
+        if os.path.exists(jsonldfilepath):
+            os.remove(jsonldfilepath)
+    finally:
+        #a new version keeps other processes from serving cached results
+        db.execute('update jsonfiles set status = ?, version = version + 1 \
+            where filetitle = (?)', (status, filetitle))
+        db.commit()
+        db.close()
+    return jobid, filetitle, status, finish_spans()
+
+#-------------------------------------------------------------------------
+def import_file(task):
+    """Runs inside a bulkimport process. Parses one file into its
+    building's store and writes its viewer copy.
+
+    Parameters:
+        ---task = (filetitle, path of the file in the upload folder)
+
+    Returns:
+        ---(filetitle, triples written, seconds taken, None or the error)
+    """
+    filetitle, jsonldfilepath = task
+    started = time.time()
+    try:
+        triples = save_in_sleepycat('_'.join(filetitle.split()), jsonldfilepath)
+        save_pretty_json(jsonldfilepath)
+    except Exception as e:
+        return filetitle, 0, time.time() - started, '%s: %s' % (type(e).__name__, e)
+    return filetitle, triples, time.time() - started, None
+
+#-------------------------------------------------------------------------
+def submit_ingest_job(db, filetitle, jsonldfilepath, run=run_ingest_job):
+    """Queues a file for ingestion on the worker pool.
+
+    Parameters:
+        ---run = the job function, run_ingest_job or run_update_job
+
+    Returns:
+        ---the id of the new job
+    """
+    jobid = uuid.uuid4().hex
+    now = datetime.now()
+    db.execute('insert into jobs (jobid, filetitle, status, phase, createdtime, updatedtime) \
+        values (?, ?, ?, ?, ?, ?)', (jobid, filetitle, 'queued', 'queued', now, now))
+    db.commit()
+    #the store is about to be rewritten by another process
+    invalidate_building('_'.join(filetitle.split()))
+    get_ingest_pool().apply_async(run, (jobid, filetitle, jsonldfilepath),
+        callback=ingest_finished)
+    return jobid
+
+#-------------------------------------------------------------------------
+def ingest_finished(result):
+    """Called in the web process once an ingest job has finished, drops
+    anything cached about the building from before the job and records
+    the spans the job measured in its worker"""
+    jobid, filetitle, status, spans = result
+    observe_spans(spans)
+    invalidate_building('_'.join(filetitle.split()))
+
+#-------------------------------------------------------------------------
+def wants_json():
+    "Returns True when the client prefers a JSON response over html"
+    best = request.accept_mimetypes.best_match(['text/html', 'application/json'])
+    return best == 'application/json'
+
+#-------------------------------------------------------------------------
+@app.route('/addfile', methods=['GET', 'POST'])
+def addfile():
+    if request.method == 'GET':
+        if session.get('logged_in'):
+            return render_template('addfile.html')
+        else:
+            return abort(401)
+
+    else:
+        filefield = 'jsonldfile'
+        if filefield not in request.files:
+            uploadmsg = 'No File was uploaded!'
+            uploadstatus = 'F'
+            return render_template('addfile.html', uploadmsg=uploadmsg, uploadstatus=uploadstatus)
+
+        elif request.files[filefield].filename == '' or request.form['filetitle'] == '' or request.form['filedesc'] == '':
+            uploadmsg = 'ERROR! Fields were empty OR No File was selected!'
+            uploadstatus = 'F'
+            return render_template('addfile.html', uploadmsg=uploadmsg, uploadstatus=uploadstatus)
+
+        elif not allowed_file(request.files[filefield].filename):
+            uploadmsg = 'ERROR! Wrong file format'
+            uploadstatus = 'F'
+            return render_template('addfile.html', uploadmsg=uploadmsg, uploadstatus=uploadstatus)
+
+        else:
+            uploadedfile = request.files[filefield]
+            uploadedfilename = secure_filename(uploadedfile.filename)
+            uploadedfilesavepath = os.path.join(app.config['UPLOAD_FOLDER'], uploadedfilename)
+            if os.path.exists(uploadedfilesavepath):
+                uploadmsg = 'ERROR! A file with the same name already exists'
+                uploadstatus = 'F'
+                return render_template('addfile.html', uploadmsg=uploadmsg, uploadstatus=uploadstatus)
+            
+            db = get_db()
+            cur = db.execute('select filetitle from jsonfiles where filetitle = (?)', (request.form['filetitle'],))
+            result = cur.fetchone()
+            if result == request.form['filetitle']:
+                uploadmsg = 'ERROR! Duplicate File title'
+                uploadstatus = 'F'
+                return render_template('addfile.html', uploadmsg=uploadmsg, uploadstatus=uploadstatus)
+
+            #all is ok
+            #uploadedfilesavepath = os.path.join(app.config['UPLOAD_FOLDER'], uploadedfilename)
+            uploadedfile.save(uploadedfilesavepath)
+
+            db = get_db()
+            db.execute('insert into jsonfiles (filetitle, description, uploadedtime, filename, status) values (?, ?, ?, ?, ?)', \
+                    (request.form['filetitle'], request.form['filedesc'], datetime.now(), uploadedfilename, 'pending'))
+            db.commit()
+
+            uploadmsg = 'File Upload Successful'
+            uploadstatus = 'T'
+
+            #save it in sleepycat db in the background
+            jobid = submit_ingest_job(db, request.form['filetitle'], uploadedfilesavepath)
+
+            if wants_json():
+                return jsonify(jobid=jobid, status=url_for('jobs', jobid=jobid)), 202
+            return render_template('addfile.html', uploadmsg=uploadmsg, uploadstatus=uploadstatus, jobid=jobid)
+
+
+#-------------------------------------------------------------------------
+@app.route('/jobs/<jobid>', methods=['GET'])
+def jobs(jobid):
+    """Returns the state of an ingest job
+
+    Parameters:
+        ---jobid = the id returned by addfile()
+
+    Returns:
+        ---json with the job status (queued, running, done or failed), the
+        current phase, the number of triples written so far and the error
+        of a failed job
+    """
+    db = get_db()
+    cur = db.execute('select jobid, filetitle, status, phase, triples, added, removed, \
+        error, createdtime, updatedtime from jobs where jobid = (?)', (jobid,))
+    result = cur.fetchone()
+    if result is None:
+        abort(404)
+    return jsonify(dict(zip(result.keys(), result)))
+
+#-------------------------------------------------------------------------
+@app.route('/update/<filetitle>', methods=['POST'])
+def update(filetitle):
+    """Replaces a building's file with a new version. Only the triples
+    that differ from the stored graph are written, in an ingest job.
+
+    Parameters:
+        ---filetitle = the title of the building
+        ---jsonldfile (form) = the new version of the jsonld file
+
+    Returns:
+        ---json with the id of the update job and the url of its status,
+        see jobs()
+    """
+    filefield = 'jsonldfile'
+    if filefield not in request.files or request.files[filefield].filename == '':
+        return jsonify(response = 'No File was uploaded!'), 400
+    if not allowed_file(request.files[filefield].filename):
+        return jsonify(response = 'ERROR! Wrong file format'), 400
+
+    db = get_db()
+    cur = db.execute('select filename, status from jsonfiles where filetitle = (?)', (filetitle,))
+    result = cur.fetchone()
+    if result is None:
+        abort(404)
+    if result[1] != 'ready':
+        return jsonify(response = 'The building is not ready, its status is %s' % result[1]), 409
+    cur = db.execute("select jobid from jobs where filetitle = (?) and status in ('queued', 'running')",
+        (filetitle,))
+    if cur.fetchone() is not None:
+        return jsonify(response = 'Another job is still running for this building'), 409
+
+    #kept next to the old upload until the update succeeded
+    uploadedfilesavepath = os.path.join(app.config['UPLOAD_FOLDER'],
+        '%s.%s.update' % (result[0], uuid.uuid4().hex))
+    request.files[filefield].save(uploadedfilesavepath)
+
+    jobid = submit_ingest_job(db, filetitle, uploadedfilesavepath, run=run_update_job)
+    return jsonify(jobid=jobid, status=url_for('jobs', jobid=jobid)), 202
+
+
+#-------------------------------------------------------------------------     
+@app.route('/viewer/<filetitle>', methods=['GET'])
+def viewer(filetitle):
+    """Displays the viewer main page
+
+    Parameters:
+        ---filetitle = the title of the file to be opened in viewer
+
+    Returns:
+        ---the viewer template passing the entire file information and the url
+        the jsonld file content is fetched from
+    """
+
+    #gets sqlite db connection instance
+    db = get_db()
+
+    #executes query to fetch details of using filetitle
+    cur = db.execute('select filetitle, description, \
+            uploadedtime, filename from jsonfiles where filetitle = (?)', (filetitle,))
+    result = cur.fetchone()
+
+
+    if result is None:
+        abort(404)
+
+    #the document itself is fetched lazily by the page from viewerJsonld()
+    return render_template('viewer.html', fileinfo=result,
+        jsonldurl=url_for('viewerJsonld', filetitle=filetitle))
+
+#-------------------------------------------------------------------------
+def read_file(path, start, stop):
+    "Yields the bytes of a file from start up to stop in chunks"
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(65536, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+#-------------------------------------------------------------------------
+@app.route('/viewer/<filetitle>/jsonld', methods=['GET'])
+def viewerJsonld(filetitle):
+    """Serves the pretty printed jsonld of a file for the viewer page
+
+    Parameters:
+        ---filetitle = the title of the file to be opened in viewer
+
+    Returns:
+        ---the document, gzip encoded when the client accepts it, streamed
+        in chunks. Supports If-None-Match against the ETag and single byte
+        ranges of the uncompressed document.
+    """
+    db = get_db()
+    cur = db.execute('select filename from jsonfiles where filetitle = (?)', (filetitle,))
+    result = cur.fetchone()
+    if result is None:
+        abort(404)
+
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], result[0])
+    path = pretty_path(filepath)
+    if not os.path.exists(path):
+        #uploaded before pretty printing moved to ingest
+        save_pretty_json(filepath)
+
+    #ranges always refer to the uncompressed document
+    encoded = request.range is None and os.path.exists(path + '.gz') and \
+        'gzip' in request.accept_encodings
+    servepath = path + '.gz' if encoded else path
+    st = os.stat(servepath)
+    etag = '%s-%x-%x' % ('gz' if encoded else 'id', int(st.st_mtime), st.st_size)
+
+    headers = {'Accept-Ranges': 'bytes', 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+    if encoded:
+        headers['Content-Encoding'] = 'gzip'
+
+    if request.if_none_match.contains(etag):
+        rv = Response(status=304, headers=headers)
+        rv.set_etag(etag)
+        return rv
+
+    start, stop, status = 0, st.st_size, 200
+    if_range = request.if_range
+    if request.range is not None and (if_range.etag == etag or
+            (if_range.etag is None and if_range.date is None)):
+        byterange = request.range.range_for_length(st.st_size)
+        if byterange is None:
+            rv = Response(status=416, headers=headers)
+            rv.headers['Content-Range'] = 'bytes */%d' % st.st_size
+            return rv
+        start, stop = byterange
+        status = 206
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, st.st_size)
+
+    headers['Content-Length'] = str(stop - start)
+    rv = Response(read_file(servepath, start, stop), status=status, headers=headers,
+        mimetype='application/json', direct_passthrough=True)
+    rv.set_etag(etag)
+    return rv
+
+#-------------------------------------------------------------------------
+@app.route('/delete/<filetitle>', methods=['GET'])
+def delete(filetitle):
+    """Deletes a jsonld file and also its associated SQLite DB entry
+    and the Sleepycat RDF Database
+
+    Parameters:
+        ---filetitle = the title of the file to be deleted
+
+    Returns:
+        ---Redirects to Index view with a response code and a response message
+    """
+    #gets db connection instance
+    db = get_db()
+
+    #executes query to fetch details of using filetitle
+    cur = db.execute('select filetitle, description, \
+        uploadedtime, filename from jsonfiles where filetitle = (?)', (filetitle,))
+    result = cur.fetchone()
+    
+    #extracts the file name
+    filename = result[3]
+
+    #creates file path
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+
+    #removes file using file path
+    os.remove(filepath)
+    remove_pretty_json(filepath)
+
+    #deletes entry of file from sqlite database
+    db.execute('delete from jsonfiles where filetitle = (?)', (filetitle,))
+    db.commit()
+
+    #creates path to sleepycat database for this file
+    SLEEPYCAT_DB_PATH = os.path.join(SLEEPYCAT_DB_FOLDER, '_'.join(filetitle.split()))
+
+    #closes any cached handle on the database before removing it
+    invalidate_building('_'.join(filetitle.split()))
+
+    #removes the search indexes built for the database
+    remove_index('_'.join(filetitle.split()))
+    remove_snapshot('_'.join(filetitle.split()))
+    remove_prefixes('_'.join(filetitle.split()))
+
+    #drops the building's graph from the shared store, or removes the
+    #entire directory containing its sleepycat database, a failed or
+    #still pending upload may not have one yet
+    if shared_storage():
+        get_shared_store().remove_graph(building_graph_uri('_'.join(filetitle.split())))
+    elif os.path.exists(SLEEPYCAT_DB_PATH):
+        shutil.rmtree(SLEEPYCAT_DB_PATH, ignore_errors=False)
+
+    return redirect(url_for('index'))
+
+
+#--------------------------------------------------------------------------
+class PrefixCompactor(object):
+    """Compacts IRIs to prefix:name form in a single pass.
+
+    Namespaces are looked up by exact prefix, longest namespace first,
+    with one dict lookup per distinct namespace length, and compacted
+    forms are memoized since the same IRIs recur across result rows.
+    """
+
+    MEMO_SIZE = 100000
+
+    def __init__(self, namespaces):
+        self.namespaces = OrderedDict(namespaces)
+        self.prefixes = dict((uri, prefix) for prefix, uri in self.namespaces.items())
+        self.lengths = sorted(set(len(uri) for uri in self.prefixes), reverse=True)
+        self.memo = dict()
+
+    def compact(self, uri):
+        "Returns the compacted form of an IRI, or the IRI itself"
+        short = self.memo.get(uri)
+        if short is not None:
+            return short
+        short = uri
+        for length in self.lengths:
+            prefix = self.prefixes.get(uri[:length])
+            if prefix is not None:
+                short = prefix + ':' + uri[length:]
+                break
+        if len(self.memo) >= self.MEMO_SIZE:
+            self.memo.clear()
+        self.memo[uri] = short
+        return short
+
+    def compact_many(self, column):
+        """Compacts a whole column of result values, unbound values become
+        ''. Falsy literals such as 0 or false keep their lexical form."""
+        compact = self.compact
+        return [compact(uri) if uri is not None else '' for uri in column]
+
+    def expand(self, name):
+        """Returns the IRI of a prefix:name form, or the name itself when
+        its prefix is not one of the namespaces"""
+        prefix, sep, local = name.partition(':')
+        if sep and prefix in self.namespaces:
+            return self.namespaces[prefix] + local
+        return name
+
+    def extended(self, namespaces):
+        """Returns a compactor over these namespaces plus the given
+        (prefix, uri) pairs, which replace namespaces of the same prefix"""
+        merged = OrderedDict(self.namespaces)
+        merged.update(namespaces)
+        return PrefixCompactor(merged.items())
+
+default_compactor = PrefixCompactor(NAMESPACES)
+
+#compactors of buildings whose jsonld @context declares its own prefixes,
+#with the file_identity() of what they were read from
+_building_compactors = dict()
+
+#--------------------------------------------------------------------------
+def context_prefixes(context):
+    """Returns the (prefix, uri) pairs a jsonld @context declares for
+    namespaces, i.e. terms mapped to an IRI ending in # or /"""
+    contexts = context if isinstance(context, list) else [context]
+    prefixes = list()
+    for ctx in contexts:
+        if not isinstance(ctx, dict):
+            continue
+        for term, value in ctx.items():
+            if isinstance(value, dict):
+                value = value.get('@id')
+            if term.startswith('@') or ':' in term or not isinstance(value, string_types):
+                continue
+            if value.endswith('#') or value.endswith('/'):
+                prefixes.append((term, value))
+    return prefixes
+
+#--------------------------------------------------------------------------
+def prefixes_path(dbname):
+    "Returns the path of the file holding the prefixes of a building's @context"
+    return os.path.join(PREFIX_DB_FOLDER, dbname + '.json')
+
+#--------------------------------------------------------------------------
+def write_prefixes(dbname, prefixes):
+    """Records the prefixes of a building's @context, whether or not the
+    building gets an index
+
+    Parameters:
+        ---prefixes = the (prefix, uri) pairs returned by context_prefixes()
+    """
+    if not os.path.exists(PREFIX_DB_FOLDER):
+        os.makedirs(PREFIX_DB_FOLDER)
+    path = prefixes_path(dbname)
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmppath, 'w') as f:
+        json.dump(list(prefixes), f)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmppath, path)
+
+#--------------------------------------------------------------------------
+def remove_prefixes(dbname):
+    "Removes the recorded prefixes of a building, if it has them"
+    path = prefixes_path(dbname)
+    if os.path.exists(path):
+        os.remove(path)
+
+#--------------------------------------------------------------------------
+def read_prefixes(dbname, conn=None):
+    """Returns the prefixes of a building's @context as recorded by
+    write_prefixes(), or in its index for a building ingested before they
+    were recorded on their own. The index is read whatever its format, an
+    index too old to be searched still holds them.
+
+    Parameters:
+        ---dbname = the folder name of the building's store
+        ---conn = optional open index of the building
+
+    Returns:
+        ---a list of [prefix, uri] pairs, empty if none were recorded
+    """
+    path = prefixes_path(dbname)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+
+    if conn is None and not os.path.exists(index_path(dbname)):
+        return list()
+    index = conn if conn is not None else sqlite3.connect(index_path(dbname))
+    try:
+        row = index.execute("select value from meta where key = 'prefixes'").fetchone()
+    except sqlite3.Error:
+        row = None
+    finally:
+        if conn is None:
+            index.close()
+    return json.loads(row[0]) if row is not None else list()
+
+#--------------------------------------------------------------------------
+def building_compactor(dbname, conn=None):
+    """Returns the compactor of a building: the default namespaces plus
+    the prefixes of the building's own @context, see read_prefixes().
+    Every endpoint compacts a building's IRIs with it, whatever path
+    answers the request.
+
+    Parameters:
+        ---dbname = the folder name of the building's store
+        ---conn = optional open index of the building
+    """
+    identity = file_identity(prefixes_path(dbname))
+    if identity is None:
+        identity = ('index', file_identity(index_path(dbname)))
+    entry = _building_compactors.get(dbname)
+    if entry is not None and entry[0] == identity:
+        return entry[1]
+
+    prefixes = read_prefixes(dbname, conn)
+    compactor = default_compactor
+    if prefixes:
+        compactor = default_compactor.extended(prefixes)
+    _building_compactors[dbname] = (identity, compactor)
+    return compactor
+
+#-------------------------------------------------------------------------
+@app.route('/getNamespaceURIs', methods=['POST'])
+def getNamespaceURIs():
+    """Returns the prefixes used to compact IRIs, including the ones
+    declared by a building's @context when its filetitle is posted"""
+    params = request.get_json(silent=True) or dict()
+    compactor = default_compactor
+    if params.get('filetitle'):
+        compactor = building_compactor('_'.join(params['filetitle'].split()))
+    d = dict(compactor.namespaces)
+    return jsonify(d)
+
+#--------------------------------------------------------------------------
+def shortenURI(uri):
+    "Compacts an IRI with the default namespaces"
+    return default_compactor.compact(uri)
+
+
+#-------------------------------------------------------------------------------
+#queries of the SPARQL fallbacks : parsed and translated once at startup,
+#user input is only ever passed in through initBindings
+QUERY_NAMESPACES = {'brick': BRICK, 'rdf': rdflib.RDF, 'rdfs': rdflib.RDFS, 'site': SITE}
+
+QUERY_TEXTS = {
+    #?class = the full IRI of the Brick class
+    'classInstances': """SELECT DISTINCT ?s WHERE {
+                    ?s rdf:type ?o.
+                    ?o rdfs:subClassOf* ?class.
+                    }""",
+}
+#?term = the lower case search term, blank node ids are never matched
+for position, var in POSITION_VARS.items():
+    QUERY_TEXTS['search_' + position] = """SELECT ?s ?p ?o WHERE {
+            ?s ?p ?o.
+            FILTER(!isBlank(?%s) && CONTAINS(LCASE(STR(?%s)), ?term))
+            }""" % (var, var)
+
+#-------------------------------------------------------------------------------
+def prepare_queries():
+    """Prepares every query of QUERY_TEXTS.
+
+    Returns:
+        ---dict from query name to the prepared query
+    """
+    queries = dict()
+    for name, text in QUERY_TEXTS.items():
+        with span('sparql_prepare'):
+            queries[name] = prepareQuery(text, initNs=QUERY_NAMESPACES)
+    return queries
+
+PREPARED_QUERIES = prepare_queries()
+
+#-------------------------------------------------------------------------------
+def class_instance_count(conn, classiri):
+    """Returns the number of instances of a class and of its subclasses
+    in a building, from its statistics, plus the instances the schema
+    itself types with them"""
+    hierarchy = class_hierarchy()
+    extra = conn.execute('select sub, sup from subclasses').fetchall()
+    count = hierarchy.rollup(read_stats(conn)['classes'], extra).get(classiri, 0)
+    return count + sum(len(hierarchy.schema_types.get(cls, ()))
+        for cls in hierarchy.subclasses(classiri, extra))
+
+#-------------------------------------------------------------------------------
+def class_rows(dbname, brickClass, deadline=None):
+    """Yields the compacted instances of a Brick class and its subclasses
+    in a building, from the class hierarchy and type index when the
+    building has one and with SPARQL otherwise
+
+    Parameters:
+        ---deadline = optional time after which the search raises
+        DeadlineExceeded, even before it finds its first row
+    """
+    conn = open_index(dbname)
+    if conn is not None:
+        try:
+            watch_deadline(conn, deadline)
+            #no instance anywhere in the hierarchy below the class, nothing to look up
+            if not class_instance_count(conn, brick_uri + brickClass):
+                return
+            compact = building_compactor(dbname, conn).compact
+            for instance in indexed_class_instances(conn, brick_uri + brickClass):
+                yield compact(instance)
+        except sqlite3.OperationalError:
+            check_deadline(deadline)
+            raise
+        finally:
+            conn.close()
+        return
+
+    with building_graph(dbname) as graph:
+        #the class hierarchy comes from the shared schema store
+        graph = with_schema(graph, deadline)
+        queryResult = graph.query(PREPARED_QUERIES['classInstances'],
+            initBindings={'class': BRICK[brickClass]})
+        compact = building_compactor(dbname).compact
+        for instance in timed_rows(queryResult, lambda row: compact(row['s'])):
+            yield instance
+
+#-------------------------------------------------------------------------------
+def timed_rows(queryResult, convert):
+    """Yields convert(row) for the rows of a SPARQL result as they are
+    evaluated, without materializing it. The time spent evaluating and
+    converting rows is added up and recorded as the sparql_eval and
+    shorten spans once the rows run out or the consumer stops."""
+    rows = iter(queryResult)
+    evaluating = shortening = 0.0
+    try:
+        while True:
+            started = time.time()
+            try:
+                row = next(rows)
+            except StopIteration:
+                evaluating += time.time() - started
+                break
+            evaluated = time.time()
+            item = convert(row)
+            evaluating += evaluated - started
+            shortening += time.time() - evaluated
+            yield item
+    finally:
+        record_span('sparql_eval', evaluating)
+        record_span('shorten', shortening)
+
+#-------------------------------------------------------------------------------
+def dataset_version(filetitle):
+    """Returns what identifies the current content of a building: its
+    upload time and the number of ingests it went through"""
+    db = get_db()
+    cur = db.execute('select uploadedtime, version from jsonfiles where filetitle = (?)', (filetitle,))
+    result = cur.fetchone()
+    return tuple(result) if result is not None else None
+
+#-------------------------------------------------------------------------------
+@app.route('/cacheStats', methods=['GET'])
+def cacheStats():
+    "Returns the hit and miss counters of the search result cache"
+    return jsonify(result_cache.stats())
+
+#-------------------------------------------------------------------------------
+def page_token(offset):
+    "Returns the opaque continuation token of the page starting at offset"
+    return base64.urlsafe_b64encode(json.dumps({'offset': offset}).encode('utf-8')).decode('ascii')
+
+#-------------------------------------------------------------------------------
+def read_page_token(token):
+    """Returns the offset encoded in a continuation token, or None if the
+    token is not one produced by page_token()"""
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))['offset']
+    except (ValueError, TypeError, KeyError, UnicodeError):
+        return None
+    if not isinstance(offset, int) or offset < 0:
+        return None
+    return offset
+
+#-------------------------------------------------------------------------------
+def wants_ndjson():
+    "Returns True when the client asked for newline delimited json rows"
+    return bool((request.json or {}).get('stream')) or \
+        request.accept_mimetypes.best == 'application/x-ndjson'
+
+#-------------------------------------------------------------------------------
+def rows_response(rows, collect, line):
+    """Delivers the rows of a search either whole, as a page, or streamed
+    as newline delimited json, without materializing more rows than the
+    response needs.
+
+    Parameters (json):
+        ---limit = optional maximum number of rows to return
+        ---cursor = optional continuation token returned with a page
+        ---stream = optional, true for an ndjson response
+
+    Parameters:
+        ---rows = a generator of result rows
+        ---collect = callable turning a list of rows into the json document
+        of the endpoint
+        ---line = callable turning a row into the json value of an ndjson line
+
+    Returns:
+        ---the response. Pages carry the token of the next page under
+        'next' (null on the last page), an ndjson stream that was cut short
+        by the limit ends with a {"next": token} line.
+    """
+    limit = request.json.get('limit')
+    cursor = request.json.get('cursor')
+    if limit is not None and (not isinstance(limit, int) or limit <= 0):
+        rows.close()
+        return jsonify(response = 'limit must be a positive integer'), 400
+    offset = 0
+    if cursor is not None:
+        offset = read_page_token(cursor)
+        if offset is None:
+            rows.close()
+            return jsonify(response = 'Invalid cursor'), 400
+
+    page = itertools.islice(rows, offset, None)
+
+    endpoint = request.endpoint
+    if wants_ndjson():
+        def generate():
+            count = 0
+            try:
+                for row in page:
+                    if count == limit:
+                        yield json.dumps({'next': page_token(offset + count)}) + '\n'
+                        break
+                    yield json.dumps(line(row)) + '\n'
+                    count += 1
+            finally:
+                rows.close()
+                result_rows.observe(count, endpoint)
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    try:
+        with span('search'):
+            result = list(page) if limit is None else list(itertools.islice(page, limit + 1))
+    finally:
+        rows.close()
+
+    if limit is None:
+        result_rows.observe(len(result), endpoint)
+        with span('serialize'):
+            return jsonify(collect(result))
+
+    result_rows.observe(len(result[:limit]), endpoint)
+    with span('serialize'):
+        d = collect(result[:limit])
+        if isinstance(d, list):
+            d = dict(result=d)
+        d['next'] = page_token(offset + limit) if len(result) > limit else None
+        return jsonify(d)
+
+#-------------------------------------------------------------------------------
+@app.route('/searchByClass', methods=['POST'])
+def searchByClass():
+    """Finds the instances of a Brick class and of its subclasses
+
+    Parameters (json):
+        ---filetitle = the title of the file to search in
+        ---brickClass = the Brick class name, without prefix
+        ---limit, cursor, stream = see rows_response()
+
+    Returns:
+        ---a json list of the compacted instance IRIs
+    """
+    filetitle = '_'.join(request.json['filetitle'].split())
+
+    if not building_exists(filetitle):
+        return jsonify(response = 'No RDF DB exists')
+
+    brickClass = request.json['brickClass'].strip()
+    key = (filetitle, 'searchByClass', brickClass, dataset_version(request.json['filetitle']))
+    rows = result_cache.rows(key, lambda: class_rows(filetitle, brickClass))
+    return rows_response(rows, collect=lambda page: page, line=lambda instance: instance)
+
+#-------------------------------------------------------------------------------
+@app.route('/stats/<filetitle>', methods=['GET'])
+def stats(filetitle):
+    """Returns the statistics recorded for a building at ingest and kept
+    up to date by its updates, without touching its graph
+
+    Parameters:
+        ---filetitle = the title of the building
+        ---top = optional number of namespaces to return, 10 by default
+
+    Returns:
+        ---json with the number of triples and distinct subjects, the
+        triples per predicate, the instances per class rolled up through
+        the class hierarchy ('classes') and typed with exactly the class
+        ('direct'), and the namespaces with the most subjects, all with
+        compacted IRIs
+    """
+    dbname = '_'.join(filetitle.split())
+    top = request.args.get('top', 10, type=int)
+    conn = open_index(dbname)
+    if conn is None:
+        return jsonify(response = 'No statistics exist'), 404
+    try:
+        recorded = read_stats(conn)
+        extra = conn.execute('select sub, sup from subclasses').fetchall()
+        compact = building_compactor(dbname, conn).compact
+    finally:
+        conn.close()
+
+    def compacted(counts):
+        return dict((compact(iri), count) for iri, count in counts.items())
+
+    namespaces = sorted(recorded['namespaces'].items(), key=lambda item: (-item[1], item[0]))[:top]
+    return jsonify(triples=recorded['triples'],
+                   subjects=recorded['subjects'],
+                   predicates=compacted(recorded['predicates']),
+                   classes=compacted(class_hierarchy().rollup(recorded['classes'], extra)),
+                   direct=compacted(recorded['classes']),
+                   namespaces=[dict(namespace=namespace, subjects=count)
+                               for namespace, count in namespaces])
+
+
+#-------------------------------------------------------------------------------
+def triple_row(s, p, o, compactor=default_compactor):
+    "Returns a custom search result row with compacted terms"
+    tmp = dict()
+    tmp['s'], tmp['p'], tmp['o'] = compactor.compact_many((s, p, o))
+    return tmp
+
+#-------------------------------------------------------------------------------
+def sparql_search_rows(graph, searchterm, position, compactor=default_compactor):
+    """Answers a custom search for one position with SPARQL, for buildings
+    that have no index. The term is bound as a query parameter, never
+    spliced into the query text.
+
+    Returns:
+        ---a generator of (position, row) pairs
+    """
+    queryResult = graph.query(PREPARED_QUERIES['search_' + position],
+        initBindings={'term': rdflib.Literal(searchterm.lower())})
+    for row in timed_rows(queryResult, lambda row: triple_row(row['s'], row['p'], row['o'], compactor)):
+        yield position, row
+
+#-------------------------------------------------------------------------------
+def scan_search_rows(graph, searchterm, compactor=default_compactor):
+    """Answers an all mode custom search for buildings that have no index
+    in a single scan of the graph, instead of one SPARQL query per
+    position. Each triple is read once and tested at all three positions,
+    with the same semantics as the SPARQL filter: the lexical form must
+    contain the term, ignoring case, and blank nodes never match.
+
+    Returns:
+        ---a generator of (position, row) pairs, a triple matching at
+        several positions is yielded once for each of them
+    """
+    needle = searchterm.lower()
+    #whether a term matches and its compacted form, terms recur across triples
+    memo = dict()
+
+    def lookup(term):
+        hit = memo.get(term)
+        if hit is None:
+            if len(memo) >= PrefixCompactor.MEMO_SIZE:
+                memo.clear()
+            matched = not isinstance(term, rdflib.BNode) and needle in text_type(term).lower()
+            hit = memo[term] = (matched, compactor.compact(term) if term is not None else '')
+        return hit
+
+    for s, p, o in graph.triples((None, None, None)):
+        smatch, sshort = lookup(s)
+        pmatch, pshort = lookup(p)
+        omatch, oshort = lookup(o)
+        if smatch:
+            yield 'subject', {'s': sshort, 'p': pshort, 'o': oshort}
+        if pmatch:
+            yield 'property', {'s': sshort, 'p': pshort, 'o': oshort}
+        if omatch:
+            yield 'object', {'s': sshort, 'p': pshort, 'o': oshort}
+
+#-------------------------------------------------------------------------------
+def search_rows(dbname, searchterm, position, deadline=None):
+    """Yields the (position, row) pairs of a custom search, from the
+    building index when there is one and with SPARQL otherwise
+
+    Parameters:
+        ---deadline = optional time after which the search raises
+        DeadlineExceeded, even before it finds its first row
+    """
+    conn = open_index(dbname)
+    if conn is not None:
+        try:
+            watch_deadline(conn, deadline)
+            compactor = building_compactor(dbname, conn)
+            for item in indexed_search_rows(conn, searchterm, position, compactor):
+                yield item
+        except sqlite3.OperationalError:
+            check_deadline(deadline)
+            raise
+        finally:
+            conn.close()
+        return
+
+    compactor = building_compactor(dbname)
+    with building_graph(dbname) as graph:
+        if deadline is not None:
+            graph = DeadlineGraph([graph], deadline)
+        if position == 'all':
+            rows = scan_search_rows(graph, searchterm, compactor)
+        else:
+            rows = sparql_search_rows(graph, searchterm, position, compactor)
+        for item in rows:
+            yield item
+
+#---------------------------------------------------------------------------------------------
+@app.route('/customSearch', methods=['POST'])
+def customSearch():
+    """Searches a building's triples for a term
+
+    Parameters (json):
+        ---filetitle = the title of the file to search in
+        ---searchTerm = the text to look for, matched as a case insensitive
+        substring of the lexical form
+        ---selectedPosition = subject, property, object or all
+        ---limit, cursor, stream = see rows_response()
+
+    Returns:
+        ---json with the type of search and the matching rows, grouped into
+        subjectwise, propertywise and objectwise lists in all mode
+    """
+    filetitle = '_'.join(request.json['filetitle'].split())
+    searchTerm = request.json['searchTerm']
+    selectedPosition = request.json['selectedPosition']
+
+    if selectedPosition != 'all' and selectedPosition not in POSITION_VARS:
+        return jsonify(response = 'Unknown search position'), 400
+
+    if not building_exists(filetitle):
+        return jsonify(response = 'No RDF DB exists')
+
+    def collect(page):
+        d = dict()
+        d['type'] = selectedPosition
+        if selectedPosition == 'all':
+            d['result'] = dict((bucket, list()) for bucket in POSITION_BUCKETS.values())
+            for position, row in page:
+                d['result'][POSITION_BUCKETS[position]].append(row)
+        else:
+            d['result'] = [row for position, row in page]
+        return d
+
+    def line(item):
+        position, row = item
+        if selectedPosition == 'all':
+            row = dict(row, bucket=POSITION_BUCKETS[position])
+        return row
+
+    #searches ignore case, so the term is cached in lower case
+    key = (filetitle, 'customSearch', searchTerm.lower(), selectedPosition,
+        dataset_version(request.json['filetitle']))
+    rows = result_cache.rows(key, lambda: search_rows(filetitle, searchTerm, selectedPosition))
+    return rows_response(rows, collect, line)
+
+#-------------------------------------------------------------------------------
+#portfolio search pool : created on the first portfolio search
+_search_pool = None
+_search_pool_lock = threading.Lock()
+
+#-------------------------------------------------------------------------------
+class DeadlineExceeded(Exception):
+    "Raised by a search that ran past its deadline"
+
+#-------------------------------------------------------------------------------
+def check_deadline(deadline):
+    "Raises DeadlineExceeded if there is a deadline and it has passed"
+    if deadline is not None and time.time() > deadline:
+        raise DeadlineExceeded()
+
+#-------------------------------------------------------------------------------
+def watch_deadline(conn, deadline):
+    """Makes sqlite interrupt the statements of an index connection once
+    the deadline has passed, they then fail with an OperationalError that
+    check_deadline() tells from other errors"""
+    if deadline is not None:
+        conn.set_progress_handler(lambda: time.time() > deadline, 1000)
+
+#-------------------------------------------------------------------------------
+def until_deadline(rows, deadline):
+    """Passes the rows of a search through, raising DeadlineExceeded at
+    the first row produced after the deadline, so that a slow search
+    stops at the next row instead of running to the end"""
+    try:
+        for row in rows:
+            if time.time() > deadline:
+                raise DeadlineExceeded()
+            yield row
+    finally:
+        rows.close()
+
+#-------------------------------------------------------------------------------
+def get_search_pool():
+    """Returns the thread pool portfolio searches fan out on. Searches
+    spend their time in the stores and the sqlite indexes, and threads
+    share the open datasets and caches of the process."""
+    global _search_pool
+    with _search_pool_lock:
+        if _search_pool is None:
+            _search_pool = ThreadPool(processes=app.config['PORTFOLIO_WORKERS'])
+        return _search_pool
+
+#-------------------------------------------------------------------------------
+def search_building(task):
+    """Runs the search of one building of a portfolio search on the
+    search pool. Results are shared with searchByClass and customSearch
+    through the result cache.
+
+    Parameters:
+        ---task = (filetitle, dataset version, brickClass or None, searchTerm,
+        selectedPosition)
+
+    Returns:
+        ---dict with the building, the status of its search (ok, timeout,
+        missing or error), its rows, whether they were truncated and the
+        seconds it took
+    """
+    filetitle, version, brickClass, searchTerm, selectedPosition = task
+    dbname = '_'.join(filetitle.split())
+    started = time.time()
+    deadline = started + app.config['PORTFOLIO_TIMEOUT']
+    maxrows = app.config['PORTFOLIO_MAX_ROWS']
+    d = {'building': filetitle, 'status': 'ok', 'rows': list(), 'truncated': False}
+
+    if brickClass is not None:
+        key = (dbname, 'searchByClass', brickClass, version)
+        produce = lambda: class_rows(dbname, brickClass, deadline)
+        line = lambda instance: instance
+    else:
+        key = (dbname, 'customSearch', searchTerm.lower(), selectedPosition, version)
+        produce = lambda: search_rows(dbname, searchTerm, selectedPosition, deadline)
+        def line(item):
+            position, row = item
+            if selectedPosition == 'all':
+                row = dict(row, bucket=POSITION_BUCKETS[position])
+            return row
+
+    try:
+        if not building_exists(dbname):
+            d['status'] = 'missing'
+        else:
+            #a search cut short by the deadline raises before it is cached,
+            #it is checked between rows and while the search reads the graph
+            rows = until_deadline(result_cache.rows(key, lambda: until_deadline(produce(), deadline)), deadline)
+            try:
+                for row in rows:
+                    if len(d['rows']) == maxrows:
+                        d['truncated'] = True
+                        break
+                    d['rows'].append(line(row))
+            finally:
+                rows.close()
+    except DeadlineExceeded:
+        d['status'] = 'timeout'
+        d['rows'] = list()
+    except Exception as e:
+        app.logger.exception('Portfolio search failed on %s', filetitle)
+        d['status'] = 'error'
+        d['error'] = text_type(e)
+        d['rows'] = list()
+    d['seconds'] = round(time.time() - started, 3)
+    return d
+
+#-------------------------------------------------------------------------------
+@app.route('/portfolioSearch', methods=['POST'])
+def portfolioSearch():
+    """Runs a class search or a custom search across many buildings in
+    parallel, each one bounded by PORTFOLIO_TIMEOUT seconds
+
+    Parameters (json):
+        ---brickClass = the Brick class name to search for, or
+        ---searchTerm and selectedPosition = as in customSearch()
+        ---buildings = optional list of file titles, all ready buildings
+        are searched by default
+        ---stream = optional, true for an ndjson response with one line per
+        building, written as soon as the building's search completes
+
+    Returns:
+        ---json with the results tagged by building, in order of completion
+    """
+    params = request.get_json(silent=True) or dict()
+    brickClass = params.get('brickClass')
+    searchTerm = params.get('searchTerm')
+    selectedPosition = params.get('selectedPosition', 'all')
+    if brickClass:
+        brickClass, searchTerm, selectedPosition = brickClass.strip(), None, None
+    elif not searchTerm:
+        return jsonify(response = 'brickClass or searchTerm is required'), 400
+    elif selectedPosition != 'all' and selectedPosition not in POSITION_VARS:
+        return jsonify(response = 'Unknown search position'), 400
+    buildings = params.get('buildings')
+    if buildings is not None and not isinstance(buildings, list):
+        return jsonify(response = 'buildings must be a list of file titles'), 400
+
+    db = get_db()
+    cur = db.execute("select filetitle, uploadedtime, version from jsonfiles \
+        where status = 'ready' order by filetitle")
+    versions = OrderedDict((row[0], (row[1], row[2])) for row in cur.fetchall())
+    if buildings is None:
+        buildings = list(versions)
+
+    tasks = list()
+    missing = list()
+    for filetitle in OrderedDict.fromkeys(buildings):
+        if filetitle in versions:
+            tasks.append((filetitle, versions[filetitle], brickClass, searchTerm, selectedPosition))
+        else:
+            missing.append({'building': filetitle, 'status': 'missing', 'rows': list(),
+                'truncated': False, 'seconds': 0})
+
+    timeout = app.config['PORTFOLIO_TIMEOUT']
+    results = get_search_pool().imap_unordered(search_building, tasks)
+
+    def merged():
+        for d in missing:
+            yield d
+        pending = OrderedDict.fromkeys(task[0] for task in tasks)
+        while pending:
+            #every search stops itself at its deadline, a building that
+            #still has not answered is stuck outside of its graph or index,
+            #e.g. waiting for its store to open
+            try:
+                d = results.next(timeout * 2)
+            except multiprocessing.TimeoutError:
+                break
+            pending.pop(d['building'], None)
+            yield d
+        for filetitle in pending:
+            yield {'building': filetitle, 'status': 'timeout', 'rows': list(),
+                'truncated': False, 'seconds': timeout}
+
+    if wants_ndjson():
+        return Response((json.dumps(d) + '\n' for d in merged()), mimetype='application/x-ndjson')
+
+    d = dict()
+    d['type'] = 'class' if brickClass is not None else selectedPosition
+    d['result'] = list(merged())
+    return jsonify(d)
+
+#-------------------------------------------------------------------------------
+def node_term(iri, compactor):
+    """Returns the rdflib term of a node given by the client: a blank node
+    label (_:b0), a compacted IRI (site:VAV_1) or a full IRI"""
+    if iri.startswith('_:'):
+        return rdflib.BNode(iri[2:])
+    return rdflib.URIRef(compactor.expand(iri))
+
+#-------------------------------------------------------------------------------
+def node_value(term, compactor):
+    "Returns the json form of a node or of one of its neighbours"
+    if isinstance(term, rdflib.Literal):
+        d = {'type': 'literal', 'value': text_type(term)}
+        if term.language:
+            d['lang'] = term.language
+        elif term.datatype:
+            d['datatype'] = compactor.compact(term.datatype)
+        return d
+    if isinstance(term, rdflib.BNode):
+        return {'type': 'bnode', 'value': term.n3()}
+    return {'type': 'uri', 'value': compactor.compact(term)}
+
+#-------------------------------------------------------------------------------
+def node_edges(triples, position, size, compactor):
+    """Groups the edges of a node by predicate, keeping only the first
+    page of neighbours of every predicate in memory.
+
+    Parameters:
+        ---triples = the (s, p, o) triples of the node from a store lookup
+        ---position = 0 to collect the subjects (incoming edges), 2 to
+        collect the objects (outgoing edges)
+        ---size = number of neighbours to return per predicate
+
+    Returns:
+        ---dict from compacted predicate to its count, first neighbours and
+        the cursor of the next page (null when there is none)
+    """
+    edges = OrderedDict()
+    for triple in triples:
+        predicate = compactor.compact(triple[1])
+        edge = edges.get(predicate)
+        if edge is None:
+            edge = edges[predicate] = {'count': 0, 'values': list()}
+        if edge['count'] < size:
+            edge['values'].append(node_value(triple[position], compactor))
+        edge['count'] += 1
+    for edge in edges.values():
+        edge['next'] = page_token(size) if edge['count'] > size else None
+    return edges
+
+#-------------------------------------------------------------------------------
+@app.route('/node/<filetitle>', methods=['GET'])
+@app.route('/node/<filetitle>/<path:iri>', methods=['GET'])
+def node(filetitle, iri=None):
+    """Returns the edges of one resource of a building, so that a client
+    can expand the graph one node at a time. The edges are read with
+    store index lookups, not SPARQL.
+
+    Parameters:
+        ---filetitle = the title of the building
+        ---iri = the resource, compacted (site:VAV_1), full or a blank node
+        label. Full IRIs can also be passed as the iri query parameter.
+        ---predicate (query) = optional, returns one page of the edges of
+        this predicate only
+        ---direction (query) = out (default) or in, with predicate
+        ---limit (query) = optional number of neighbours per predicate
+        ---cursor (query) = optional continuation token, with predicate
+
+    Returns:
+        ---json with the node and its outgoing and incoming edges grouped
+        by predicate, or with one page of neighbours when a predicate is given
+    """
+    dbname = '_'.join(filetitle.split())
+    iri = request.args.get('iri', iri)
+    if not iri:
+        return jsonify(response = 'No node given'), 400
+
+    size = request.args.get('limit', app.config['NODE_PAGE_SIZE'], type=int)
+    if size <= 0:
+        return jsonify(response = 'limit must be a positive integer'), 400
+    direction = request.args.get('direction', 'out')
+    if direction not in ('out', 'in'):
+        return jsonify(response = 'direction must be out or in'), 400
+    offset = 0
+    if 'cursor' in request.args:
+        offset = read_page_token(request.args['cursor'])
+        if offset is None:
+            return jsonify(response = 'Invalid cursor'), 400
+
+    if not building_exists(dbname):
+        return jsonify(response = 'No RDF DB exists'), 404
+
+    compactor = building_compactor(dbname)
+    term = node_term(iri, compactor)
+    with building_graph(dbname) as graph:
+        if graph is None:
+            return jsonify(response = 'No RDF DB exists'), 404
+
+        d = dict()
+        d['node'] = node_value(term, compactor)
+        if 'predicate' in request.args:
+            predicate = rdflib.URIRef(compactor.expand(request.args['predicate']))
+            if direction == 'out':
+                pattern, position = (term, predicate, None), 2
+            else:
+                pattern, position = (None, predicate, term), 0
+            page = itertools.islice(graph.triples(pattern), offset, offset + size + 1)
+            values = [node_value(triple[position], compactor) for triple in page]
+            d['predicate'] = compactor.compact(predicate)
+            d['direction'] = direction
+            d['values'] = values[:size]
+            d['next'] = page_token(offset + size) if len(values) > size else None
+            return jsonify(d)
+
+        d['outgoing'] = node_edges(graph.triples((term, None, None)), 2, size, compactor)
+        d['incoming'] = node_edges(graph.triples((None, None, term)), 0, size, compactor)
+        return jsonify(d)
+
+#-------------------------------------------------------------------------------
+#admission control of /sparql : running queries of the process and per building
+_sparql_slots = None
+_building_slots = dict()
+_sparql_slots_lock = threading.Lock()
+
+#-------------------------------------------------------------------------------
+class DeadlineGraph(UnionGraph):
+    """Read-only view over a building graph and the schema graphs that
+    raises DeadlineExceeded from the first triple read after the
+    deadline, so that a query stops wherever its evaluation is"""
+
+    def __init__(self, graphs, deadline):
+        super(DeadlineGraph, self).__init__(graphs)
+        self.deadline = deadline
+
+    def triples(self, triple):
+        if time.time() > self.deadline:
+            raise DeadlineExceeded()
+        for t in super(DeadlineGraph, self).triples(triple):
+            if time.time() > self.deadline:
+                raise DeadlineExceeded()
+            yield t
+
+#-------------------------------------------------------------------------------
+def construct_triples(graph, query):
+    """Evaluates a translated CONSTRUCT query lazily. rdflib builds the
+    whole result graph before returning any of it, here the template is
+    filled one solution at a time, so that a consumer stopping at the row
+    cap also stops the evaluation.
+
+    Returns:
+        ---a generator of the distinct constructed triples, only those
+        already yielded are remembered
+    """
+    main = query.algebra
+    if main.datasetClause:
+        raise ValueError('FROM and FROM NAMED are not supported')
+    ctx = QueryContext(graph)
+    ctx.prologue = query.prologue
+    #a CONSTRUCT WHERE query uses its pattern as the template
+    template = main.template or main.p.p.triples
+    seen = set()
+    for solution in evalPart(ctx, main.p):
+        #blank nodes of the template are new for every solution
+        bnodes = defaultdict(rdflib.BNode)
+        for pattern in template:
+            triple = tuple(bnodes[term] if isinstance(term, rdflib.BNode) else solution.get(term)
+                for term in pattern)
+            if None not in triple and triple not in seen:
+                seen.add(triple)
+                yield triple
+
+#-------------------------------------------------------------------------------
+def acquire_sparql_slot(dbname):
+    """Takes a slot for a query on a building without waiting, both from
+    the process wide SPARQL_MAX_QUERIES and from the building's own
+    SPARQL_MAX_PER_BUILDING.
+
+    Returns:
+        ---a callable releasing the slots, or None when either is full
+    """
+    global _sparql_slots
+    with _sparql_slots_lock:
+        if _sparql_slots is None:
+            _sparql_slots = threading.BoundedSemaphore(app.config['SPARQL_MAX_QUERIES'])
+        slots = _building_slots.get(dbname)
+        if slots is None:
+            slots = _building_slots[dbname] = threading.BoundedSemaphore(app.config['SPARQL_MAX_PER_BUILDING'])
+
+    if not _sparql_slots.acquire(False):
+        return None
+    if not slots.acquire(False):
+        _sparql_slots.release()
+        return None
+
+    def release():
+        slots.release()
+        _sparql_slots.release()
+    return release
+
+#-------------------------------------------------------------------------------
+def sparql_term(term):
+    "Returns the SPARQL 1.1 json form of a result term"
+    if isinstance(term, rdflib.Literal):
+        d = {'type': 'literal', 'value': text_type(term)}
+        if term.language:
+            d['xml:lang'] = term.language
+        elif term.datatype:
+            d['datatype'] = text_type(term.datatype)
+        return d
+    if isinstance(term, rdflib.BNode):
+        return {'type': 'bnode', 'value': text_type(term)}
+    return {'type': 'uri', 'value': text_type(term)}
+
+#-------------------------------------------------------------------------------
+def csv_line(values):
+    "Returns one line of a csv result"
+    out = io.BytesIO()
+    csv.writer(out).writerow([text_type(value).encode('utf-8') if value is not None else ''
+        for value in values])
+    return out.getvalue()
+
+#-------------------------------------------------------------------------------
+@app.route('/sparql/<filetitle>', methods=['GET', 'POST'])
+def sparql(filetitle):
+    """Runs a read-only SPARQL query against a building graph together
+    with the schema graphs. Queries are bounded by a wall clock timeout
+    and a row cap, and only a few run at a time, per building and per
+    process. A query over either limit is refused at once with a 429.
+
+    Parameters:
+        ---filetitle = the title of the building
+        ---query (query string, form or application/sparql-query body) =
+        a SELECT, CONSTRUCT or ASK query, the default and building prefixes
+        are predeclared
+        ---format = optional json or csv for SELECT results, json by default
+        or as negotiated with the Accept header
+        ---timeout = optional seconds, at most SPARQL_TIMEOUT
+        ---limit = optional number of rows, at most SPARQL_MAX_ROWS
+
+    Returns:
+        ---a streamed response: SPARQL json or csv results for SELECT,
+        n-triples for CONSTRUCT and a SPARQL json boolean for ASK. Results
+        cut short by the timeout or the row cap end with "truncated": true
+        in json, a query that times out before its first result gets a 503.
+        A CONSTRUCT query is evaluated only as far as the row cap.
+    """
+    dbname = '_'.join(filetitle.split())
+    if request.mimetype == 'application/sparql-query':
+        querytext = request.get_data(as_text=True)
+    else:
+        querytext = request.values.get('query')
+    if not querytext:
+        return jsonify(response = 'No query given'), 400
+
+    timeout = min(request.values.get('timeout', app.config['SPARQL_TIMEOUT'], type=float),
+        app.config['SPARQL_TIMEOUT'])
+    maxrows = min(request.values.get('limit', app.config['SPARQL_MAX_ROWS'], type=int),
+        app.config['SPARQL_MAX_ROWS'])
+    fmt = request.values.get('format')
+    if fmt is None:
+        best = request.accept_mimetypes.best_match(['application/sparql-results+json', 'text/csv'])
+        fmt = 'csv' if best == 'text/csv' else 'json'
+    if fmt not in ('json', 'csv'):
+        return jsonify(response = 'format must be json or csv'), 400
+
+    if not building_exists(dbname):
+        return jsonify(response = 'No RDF DB exists'), 404
+
+    namespaces = dict(QUERY_NAMESPACES)
+    namespaces.update(building_compactor(dbname).namespaces)
+    try:
+        with span('sparql_prepare'):
+            parsed = parseQuery(querytext)
+    except Exception as e:
+        return jsonify(response = 'Invalid query: %s' % e), 400
+    #the type is checked before translating, rdflib cannot translate DESCRIBE
+    kind = parsed[1].name
+    if kind not in ('SelectQuery', 'ConstructQuery', 'AskQuery'):
+        return jsonify(response = 'Only SELECT, CONSTRUCT and ASK queries are supported'), 400
+    try:
+        with span('sparql_prepare'):
+            q = translateQuery(parsed, initNs=namespaces)
+    except Exception as e:
+        return jsonify(response = 'Invalid query: %s' % e), 400
+
+    release = acquire_sparql_slot(dbname)
+    if release is None:
+        response = jsonify(response = 'Too many queries are running, try again later')
+        response.headers['Retry-After'] = '1'
+        return response, 429
+
+    graphs = building_graph(dbname)
+    try:
+        graph = graphs.__enter__()
+        deadline = time.time() + timeout
+        view = DeadlineGraph([graph] + schema_graphs(), deadline)
+        with span('sparql_eval'):
+            if kind == 'ConstructQuery':
+                rows = construct_triples(view, q)
+            else:
+                result = view.query(q)
+            if kind == 'AskQuery':
+                answer = bool(result.askAnswer)
+            elif kind == 'SelectQuery':
+                rows = iter(result)
+            first = None if kind == 'AskQuery' else next(rows, None)
+    except DeadlineExceeded:
+        graphs.__exit__(None, None, None)
+        release()
+        return jsonify(response = 'The query timed out after %g seconds' % timeout), 503
+    except Exception as e:
+        graphs.__exit__(None, None, None)
+        release()
+        app.logger.exception('SPARQL query failed on %s', filetitle)
+        return jsonify(response = 'The query failed: %s' % e), 400
+
+    if kind == 'AskQuery':
+        graphs.__exit__(None, None, None)
+        release()
+        return jsonify(head=dict(), boolean=answer)
+
+    def results():
+        """Yields the rows of the query, at most maxrows of them, and
+        finally whether they were cut short"""
+        count = 0
+        truncated = False
+        try:
+            row = first
+            while row is not None:
+                if count == maxrows:
+                    truncated = True
+                    break
+                yield row
+                count += 1
+                try:
+                    row = next(rows, None)
+                except DeadlineExceeded:
+                    truncated = True
+                    break
+        finally:
+            graphs.__exit__(None, None, None)
+            release()
+            result_rows.observe(count, 'sparql')
+        yield truncated
+
+    def generate():
+        items = results()
+        if kind == 'ConstructQuery':
+            for item in items:
+                if isinstance(item, bool):
+                    break
+                yield (u' '.join(term.n3() for term in item) + u' .\n').encode('utf-8')
+            return
+
+        names = [text_type(var) for var in result.vars]
+        if fmt == 'csv':
+            yield csv_line(names)
+            for item in items:
+                if isinstance(item, bool):
+                    break
+                yield csv_line(item)
+            return
+
+        yield json.dumps({'head': {'vars': names}})[:-1] + ', "results": {"bindings": ['
+        separator = ''
+        for item in items:
+            if isinstance(item, bool):
+                yield ']}, "truncated": %s}' % json.dumps(item)
+                break
+            binding = dict((name, sparql_term(value)) for name, value in zip(names, item)
+                if value is not None)
+            yield separator + json.dumps(binding)
+            separator = ', '
+
+    if kind == 'ConstructQuery':
+        mimetype = 'application/n-triples'
+    elif fmt == 'csv':
+        mimetype = 'text/csv'
+    else:
+        mimetype = 'application/sparql-results+json'
+    return Response(generate(), mimetype=mimetype)
+
+#-------------------------------------------------------------------------------
+class TermIndex(object):
+    """Sorted prefix index over the compacted terms of a building: the
+    classes of the schema and every IRI of the building graph. Each term
+    is keyed by its lower cased compacted form and by its lower cased
+    local name, so that 'brick:ah' and 'ah' both find brick:AHU."""
+
+    def __init__(self, terms):
+        #every term is held once, keys point into it through an array of ids
+        self.terms = sorted(terms)
+        pairs = list()
+        for termid, term in enumerate(self.terms):
+            key = term.lower()
+            pairs.append((key, termid))
+            local = key.split(':', 1)[1] if ':' in key else None
+            if local:
+                pairs.append((local, termid))
+        pairs.sort()
+        self.keys = [key for key, termid in pairs]
+        self.ids = array('I', [termid for key, termid in pairs])
+        #a rough count of the bytes held, for the memory budget of the cache
+        self.size = sum(sys.getsizeof(term) + 8 for term in self.terms) + \
+            sum(sys.getsizeof(key) + 12 for key in self.keys)
+
+    def complete(self, prefix, limit):
+        "Returns up to limit distinct terms having a key starting with prefix"
+        prefix = prefix.lower()
+        result = list()
+        seen = set()
+        i = bisect_left(self.keys, prefix)
+        while i < len(self.keys) and len(result) < limit and self.keys[i].startswith(prefix):
+            term = self.terms[self.ids[i]]
+            if term not in seen:
+                seen.add(term)
+                result.append(term)
+            i += 1
+        return result
+
+#-------------------------------------------------------------------------------
+class TermIndexCache(object):
+    """Process wide cache of the TermIndex of each building, built on the
+    first autocomplete and rebuilt when the building's version changes.
+    Least recently used indexes are evicted once their total size passes
+    maxbytes."""
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, dbname, version, build):
+        """Returns the TermIndex of a building.
+
+        Parameters:
+            ---version = the building's dataset_version(), a cached index of
+            another version is rebuilt
+            ---build = callable returning a new TermIndex of the building
+        """
+        with self.lock:
+            entry = self.entries.pop(dbname, None)
+            if entry is not None:
+                if entry[0] == version:
+                    self.entries[dbname] = entry
+                    return entry[1]
+                self.size -= entry[1].size
+
+        #built outside the lock, other buildings keep being served meanwhile
+        with span('term_index'):
+            terms = build()
+        with self.lock:
+            previous = self.entries.pop(dbname, None)
+            if previous is not None:
+                self.size -= previous[1].size
+            self.entries[dbname] = (version, terms)
+            self.size += terms.size
+            while self.size > self.maxbytes and len(self.entries) > 1:
+                self.size -= self.entries.popitem(last=False)[1][1].size
+        return terms
+
+    def invalidate(self, dbname):
+        "Drops the index of a building"
+        with self.lock:
+            entry = self.entries.pop(dbname, None)
+            if entry is not None:
+                self.size -= entry[1].size
+
+term_index_cache = TermIndexCache(app.config['AUTOCOMPLETE_MEMORY'])
+
+#-------------------------------------------------------------------------------
+def build_term_index(dbname):
+    "Returns a new TermIndex of a building"
+    compact = building_compactor(dbname).compact
+    hierarchy = class_hierarchy()
+    terms = set(compact(cls) for cls in itertools.chain(hierarchy.children, hierarchy.parents))
+    with building_graph(dbname) as graph:
+        for triple in graph.triples((None, None, None)):
+            for term in triple:
+                if isinstance(term, rdflib.URIRef):
+                    terms.add(compact(term))
+    return TermIndex(terms)
+
+#-------------------------------------------------------------------------------
+@app.route('/autocomplete/<filetitle>', methods=['GET'])
+def autocomplete(filetitle):
+    """Completes a partly typed term of a building
+
+    Parameters:
+        ---filetitle = the title of the building
+        ---q = the beginning of a compacted term, e.g. site:VAV_1 or
+        brick:Zone, or of its local name, e.g. zone_temp, ignoring case
+        ---limit = optional maximum number of terms, AUTOCOMPLETE_LIMIT by default
+
+    Returns:
+        ---a json list of compacted terms under 'result', in alphabetical
+        order of the key that matched
+    """
+    dbname = '_'.join(filetitle.split())
+    prefix = request.args.get('q', '').strip()
+    limit = request.args.get('limit', app.config['AUTOCOMPLETE_LIMIT'], type=int)
+    if limit <= 0:
+        return jsonify(response = 'limit must be a positive integer'), 400
+    if not building_exists(dbname):
+        return jsonify(response = 'No RDF DB exists'), 404
+    if not prefix:
+        return jsonify(result=list())
+
+    terms = term_index_cache.get(dbname, dataset_version(filetitle), lambda: build_term_index(dbname))
+    result = terms.complete(prefix, limit)
+    result_rows.observe(len(result), 'autocomplete')
+    return jsonify(result=result)
+
+#-------------------------------------------------------------------------------
+def preload_schema():
+    """Copies the schema graphs into an in-memory dataset that replaces the
+    schema store, and builds the class hierarchy and runs the class query
+    once, so that workers forked afterwards share all of it copy-on-write.
+    No Sleepycat handle is left open, the workers open their own.
+
+    Returns:
+        ---the number of schema triples loaded
+    """
+    global _schema_store, _shared_store, _class_hierarchy
+    stored = get_schema_store()
+    ds = rdflib.Dataset()
+    ts = 0
+    with span('schema_parse'):
+        for graphuri, path in SCHEMA_GRAPHS:
+            graph = ds.graph(rdflib.URIRef(graphuri))
+            source = stored.get_context(rdflib.URIRef(graphuri))
+            graph.addN((s, p, o, graph) for s, p, o in source.triples((None, None, None)))
+            ts += len(graph)
+
+    with _schema_lock:
+        if not shared_storage():
+            stored.close()
+        _schema_store = ds
+    with _shared_lock:
+        if _shared_store is not None:
+            _shared_store.close()
+            _shared_store = None
+
+    _class_hierarchy = None
+    class_hierarchy()
+    #the first evaluation imports and sets up rdflib's SPARQL evaluation
+    with span('sparql_eval'):
+        list(with_schema(rdflib.Graph()).query(PREPARED_QUERIES['classInstances'],
+            initBindings={'class': BRICK['Point']}))
+    return ts
+
+#-------------------------------------------------------------------------------
+def reset_after_fork():
+    """Drops what a forked worker inherits but must not share with its
+    parent or its siblings: Sleepycat handles, snapshot maps, pools,
+    cached results and histograms, along with their locks. Handles are dropped without
+    being closed, closing them would close them for the parent too. The
+    sqlite pool drops inherited connections by itself."""
+    global _shared_store, _ingest_pool, _search_pool, _sparql_slots
+    _shared_store = None
+    _ingest_pool = None
+    _search_pool = None
+    _sparql_slots = None
+    _building_slots.clear()
+    _snapshots.clear()
+    _building_compactors.clear()
+    for cache in (dataset_cache, result_cache, term_index_cache):
+        cache.lock = threading.Lock()
+        cache.entries = OrderedDict()
+    term_index_cache.size = 0
+    dataset_cache.opening = dict()
+    dataset_cache.stale = set()
+    #the parent's observations are in its own metrics file already
+    for histogram in HISTOGRAMS:
+        histogram.reset()
+
+#-------------------------------------------------------------------------------
+def run_worker(server, number):
+    """Runs in a forked worker: resets the inherited state, warms up what
+    is per process and serves requests until it is told to stop"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    started = time.time()
+    reset_after_fork()
+    db_pool.put(db_pool.get())
+    get_schema_store()
+    seconds = time.time() - started
+    record_span('worker_warmup', seconds)
+
+    def publish_metrics():
+        while True:
+            write_metrics()
+            time.sleep(1)
+    publisher = threading.Thread(target=publish_metrics, name='metrics')
+    publisher.daemon = True
+    publisher.start()
+    print('Worker %d (pid %d) ready in %.3fs.' % (number, os.getpid(), seconds))
+    #the worker leaves through os._exit(), which does not flush stdout
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        os._exit(0)
+
+#-------------------------------------------------------------------------------
+@app.cli.command('serve')
+@click.option('--host', default='127.0.0.1', help='Interface to listen on.')
+@click.option('--port', default=5000, help='Port to listen on.')
+@click.option('--workers', default=multiprocessing.cpu_count(), help='Number of worker processes.')
+def serve_command(host, port, workers):
+    """Serves the application from several worker processes. The schema,
+    the class hierarchy and the prepared queries are loaded once, before
+    the workers are forked, and the workers accept connections on the one
+    listening socket. Workers that exit are replaced."""
+    started = time.time()
+    #every worker writes its histograms here, /metrics adds them up
+    folder = os.path.join(APP_ROOT, 'metrics', str(os.getpid()))
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    app.config['METRICS_FOLDER'] = folder
+    ts = preload_schema()
+    connect_db().close()
+    write_metrics()
+    print('Preloaded %d schema triples in %.3fs.' % (ts, time.time() - started))
+
+    server = make_server(host, port, app, threaded=True)
+    print('Listening on http://%s:%d/ with %d workers.' % (host, server.port, workers))
+    #flushed before forking, or the workers would print it again
+    sys.stdout.flush()
+
+    children = dict()
+
+    def spawn(number):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(server, number)
+        children[pid] = number
+
+    def stop(signum, frame):
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        shutil.rmtree(folder, ignore_errors=True)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for number in range(workers):
+        spawn(number)
+
+    while True:
+        try:
+            pid, status = os.wait()
+        except OSError:
+            continue
+        number = children.pop(pid, None)
+        if number is not None:
+            retire_metrics(pid)
+            print('Worker %d (pid %d) exited with status %d, restarting it.' % (number, pid, status))
+            spawn(number)
 
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
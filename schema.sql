@@ -3,5 +3,26 @@ create table jsonfiles (
     filetitle text primary key,
     description text not null,
     uploadedtime timestamp not null,
-    filename text not null
-);
\ No newline at end of file
+    filename text not null,
+    status text not null default 'ready',
+    version integer not null default 0,
+    triplecount integer,
+    filesize integer,
+    ingestseconds real
+);
+
+create index if not exists jsonfiles_uploadedtime on jsonfiles (uploadedtime, filetitle);
+
+drop table if exists jobs;
+create table jobs (
+    jobid text primary key,
+    filetitle text not null,
+    status text not null,
+    phase text not null,
+    triples integer not null default 0,
+    added integer,
+    removed integer,
+    error text,
+    createdtime timestamp not null,
+    updatedtime timestamp not null
+);
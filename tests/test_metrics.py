@@ -0,0 +1,73 @@
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import jsonldviewer
+
+
+def metric_count(text, name, label, value):
+    "Returns the _count of one series in a /metrics response, 0 if absent"
+    pattern = r'^%s_count\{%s="%s"\} (\d+)$' % (re.escape(name), label, re.escape(value))
+    match = re.search(pattern, text, re.M)
+    return int(match.group(1)) if match else 0
+
+
+class MergedMetricsTest(unittest.TestCase):
+    "Histograms of forked workers are added up without the parent's twice"
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = jsonldviewer.app.config['METRICS_FOLDER']
+        jsonldviewer.app.config['METRICS_FOLDER'] = self.folder
+        self.client = jsonldviewer.app.test_client()
+
+    def tearDown(self):
+        jsonldviewer.app.config['METRICS_FOLDER'] = self.saved
+        shutil.rmtree(self.folder)
+
+    def fork_worker(self, requests):
+        "Forks a worker that answers requests and writes its metrics, returns its pid"
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                jsonldviewer.reset_after_fork()
+                client = jsonldviewer.app.test_client()
+                for i in range(requests):
+                    client.post('/getNamespaceURIs', data=json.dumps(dict()),
+                        content_type='application/json')
+                jsonldviewer.write_metrics()
+                status = 0
+            finally:
+                os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        return pid
+
+    def test_forked_workers(self):
+        #as the serve command does once the schema is preloaded
+        self.client.post('/getNamespaceURIs', data=json.dumps(dict()),
+            content_type='application/json')
+        jsonldviewer.write_metrics()
+        parent = jsonldviewer.span_seconds.state()['sparql_prepare'][2]
+
+        first = self.fork_worker(2)
+        self.fork_worker(3)
+        #the first worker exits and is replaced
+        jsonldviewer.retire_metrics(first)
+        self.assertFalse(os.path.exists(jsonldviewer.metrics_path(first)))
+        self.fork_worker(1)
+
+        text = self.client.get('/metrics').data.decode('utf-8')
+        self.assertEqual(metric_count(text, 'jsonldviewer_request_seconds', 'endpoint',
+            'getNamespaceURIs'), 7)
+        self.assertEqual(metric_count(text, 'jsonldviewer_span_seconds', 'span',
+            'sparql_prepare'), parent)
+
+
+if __name__ == '__main__':
+    unittest.main()
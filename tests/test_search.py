@@ -0,0 +1,119 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import rdflib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import jsonldviewer
+
+SITE = rdflib.Namespace(jsonldviewer.site_uri)
+BRICK = rdflib.Namespace(jsonldviewer.brick_uri)
+XSD = rdflib.Namespace('http://www.w3.org/2001/XMLSchema#')
+
+FOLDERS = ['SLEEPYCAT_DB_FOLDER', 'INDEX_DB_FOLDER', 'SNAPSHOT_DB_FOLDER', 'PREFIX_DB_FOLDER']
+
+
+class BuildingTestCase(unittest.TestCase):
+    """Runs against buildings written to temporary folders by the same
+    writers an ingest uses, with a snapshot and optionally an index"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.saved = dict((name, getattr(jsonldviewer, name)) for name in FOLDERS)
+        for name in FOLDERS:
+            setattr(jsonldviewer, name, os.path.join(self.root, name.lower()))
+        self.database = jsonldviewer.app.config['DATABASE']
+        jsonldviewer.app.config['DATABASE'] = os.path.join(self.root, 'jsonldviewer.db')
+        with jsonldviewer.app.app_context():
+            jsonldviewer.init_db()
+        self.client = jsonldviewer.app.test_client()
+
+    def tearDown(self):
+        for name, folder in self.saved.items():
+            setattr(jsonldviewer, name, folder)
+        jsonldviewer.app.config['DATABASE'] = self.database
+        jsonldviewer._snapshots.clear()
+        jsonldviewer._building_compactors.clear()
+        shutil.rmtree(self.root)
+
+    def write_building(self, dbname, triples, index=True):
+        "Writes the snapshot, the prefixes and, if asked, the index of a building"
+        os.makedirs(jsonldviewer.store_path(dbname))
+        snapshot = jsonldviewer.SnapshotWriter(dbname)
+        snapshot.add(triples)
+        snapshot.close()
+        if index:
+            writer = jsonldviewer.BuildingIndexWriter(dbname)
+            writer.add(triples)
+            writer.close()
+        jsonldviewer.write_prefixes(dbname, [])
+
+    def custom_search(self, dbname, searchterm, position):
+        jsonldviewer.result_cache.invalidate(dbname)
+        response = self.client.post('/customSearch', content_type='application/json',
+            data=json.dumps(dict(filetitle=dbname, searchTerm=searchterm, selectedPosition=position)))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data.decode('utf-8'))['result']
+
+    def assertSameSearch(self, triples, searchterm, position):
+        "Searches a building with and without an index and returns the result of both"
+        self.write_building('indexed', triples)
+        self.write_building('unindexed', triples, index=False)
+        indexed = self.custom_search('indexed', searchterm, position)
+        unindexed = self.custom_search('unindexed', searchterm, position)
+        if position == 'all':
+            indexed = dict((key, sorted(rows)) for key, rows in indexed.items())
+            unindexed = dict((key, sorted(rows)) for key, rows in unindexed.items())
+        else:
+            indexed, unindexed = sorted(indexed), sorted(unindexed)
+        self.assertEqual(indexed, unindexed)
+        return indexed
+
+
+class FalsyLiteralTest(BuildingTestCase):
+    "Literals whose value is falsy keep their lexical form on every path"
+
+    triples = [
+        (SITE.Sensor_1, BRICK.hasValue, rdflib.Literal(0)),
+        (SITE.Sensor_2, BRICK.hasValue, rdflib.Literal('0')),
+        (SITE.Sensor_3, BRICK.hasValue, rdflib.Literal(False)),
+    ]
+
+    def test_object_search(self):
+        rows = self.assertSameSearch(self.triples, '0', 'object')
+        self.assertEqual([row['o'] for row in rows], ['0', '0'])
+
+    def test_all_search(self):
+        result = self.assertSameSearch(self.triples, 'false', 'all')
+        self.assertEqual([row['o'] for row in result['objectwise']], ['false'])
+
+
+
+class BlankNodeTest(BuildingTestCase):
+    "Blank node ids never match a search, whether the building has an index or not"
+
+    point = rdflib.BNode('a1b2')
+    triples = [
+        (SITE.AHU_1, BRICK.hasPoint, point),
+        (point, rdflib.RDF.type, BRICK.Supply_Air_Temperature_Sensor),
+    ]
+
+    def test_short_search(self):
+        result = self.assertSameSearch(self.triples, 'a', 'all')
+        self.assertEqual(len(result['subjectwise']), 1)
+        self.assertEqual(len(result['objectwise']), 1)
+
+    def test_trigram_search(self):
+        self.assertEqual(self.assertSameSearch(self.triples, 'a1b', 'all'),
+            {'subjectwise': [], 'propertywise': [], 'objectwise': []})
+
+    def test_position_search(self):
+        self.assertEqual(self.assertSameSearch(self.triples, 'a1b', 'object'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()